@@ -0,0 +1,53 @@
+"""
+Microbenchmark of creating model objects, directly and by loading API data
+with the model schema as when a list page is fetched.
+
+    PYTHONPATH=. python benchmarks/model_init.py
+"""
+import timeit
+import tracemalloc
+import uuid
+
+from visma.models import Customer
+
+NUMBER = 10000
+
+
+def make_kwargs():
+    return dict(
+        id=uuid.uuid4(), name='TestCustomer AB', invoice_city='Helsingborg',
+        invoice_postal_code='25234', customer_number='1337',
+        email_address='customer@example.com',
+        terms_of_payment_id=uuid.uuid4(),
+        reverse_charge_on_construction_services=False,
+        is_private_person=False, is_active=True, discount_percentage=0)
+
+
+def run(create):
+    seconds = min(timeit.repeat(create, number=NUMBER, repeat=3))
+    return seconds / NUMBER * 1e6
+
+
+def memory(create):
+    tracemalloc.start()
+    objs = [create() for _ in range(NUMBER)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size / NUMBER
+
+
+if __name__ == '__main__':
+    kwargs = make_kwargs()
+    data = Customer.objects.schema.dump(Customer(**kwargs))
+    schema = Customer.objects.schema
+
+    def create():
+        return Customer(**kwargs)
+
+    def load():
+        return schema.load(data)
+
+    print(f'Customer(**kwargs): {run(create):.1f} us per object')
+    print(f'schema.load(data):  {run(load):.1f} us per object')
+    print(f'Memory:             {memory(create) / 1024:.1f} KiB per object')
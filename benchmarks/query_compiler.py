@@ -0,0 +1,47 @@
+"""
+Microbenchmark of compiling a query to API parameters, with and without the
+compiled query cache of the query compiler.
+
+    PYTHONPATH=. python benchmarks/query_compiler.py
+"""
+import datetime
+import timeit
+import uuid
+
+from visma.api import VismaQueryCompiler
+from visma.models import Article
+from visma.query import APIQuery, Q, TTLCache
+
+NUMBER = 20000
+
+
+def compile_query(i):
+    query = APIQuery(model=Article, query_compiler=VismaQueryCompiler)
+    query.add_filter(
+        False,
+        Q(name__icontains=f'box {i}') | Q(number__startswith=str(i)),
+        changed_utc__gte=datetime.datetime(2018, 6, 1) +
+        datetime.timedelta(seconds=i),
+        net_price__lt=100 + i,
+        unit_id__in=[uuid.UUID(int=i), uuid.UUID(int=i + 1)])
+    query.add_filter(True, coding_id=uuid.UUID(int=i))
+    query.add_ordering('-changed_utc', 'name')
+    compiler = query.query_compiler(query)
+    compiler.compile()
+    return compiler.get_query_params()
+
+
+def run(template_cache):
+    VismaQueryCompiler.template_cache = template_cache
+    counter = iter(range(NUMBER * 10))
+    seconds = min(timeit.repeat(lambda: compile_query(next(counter)),
+                                number=NUMBER, repeat=3))
+    return seconds / NUMBER * 1e6
+
+
+if __name__ == '__main__':
+    without_cache = run(None)
+    with_cache = run(TTLCache(maxsize=1024, ttl=None))
+    print(f'Without cache: {without_cache:.1f} us per query')
+    print(f'With cache:    {with_cache:.1f} us per query')
+    print(f'Saving:        {1 - with_cache / without_cache:.0%}')
@@ -24,6 +24,7 @@ REQUIRED = [
 # What packages are optional?
 EXTRAS = {
     # 'fancy feature': ['django'],
+    'async': ['aiohttp'],
 }
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -0,0 +1,125 @@
+"""Fakes shared by the tests."""
+import asyncio
+import re
+import threading
+import uuid
+
+import pytest
+from marshmallow import fields
+
+from visma.api import VismaQueryCompiler
+from visma.base import VismaModel
+from visma.models import PaginatedResponse
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeAPI:
+    """
+    Serves rows as a paginated list the way the Visma API would, ordered on
+    $orderby. The params of every request are recorded in calls.
+
+    :param list rows: The rows to serve, as JSON data.
+    :param filter_rows: Called with the rows and the $filter of a request,
+        if there is one, and returns the matching rows. Without it $filter
+        is ignored.
+    """
+    QUERY_COMPILER_CLASS = VismaQueryCompiler
+
+    def __init__(self, rows=None, filter_rows=None):
+        self.rows = list(rows or [])
+        self.filter_rows = filter_rows
+        self.calls = list()
+        self.server_time = '2018-06-21T16:23:13.1083743Z'
+        self.lock = threading.Lock()
+
+    def get_params(self, name):
+        """Return the value of the param name in each request."""
+        return [call.get(name) for call in self.calls]
+
+    def get(self, endpoint, params=None, **kwargs):
+        params = dict(params or {})
+        with self.lock:
+            self.calls.append(params)
+
+        rows = self.rows
+        if self.filter_rows is not None and '$filter' in params:
+            rows = self.filter_rows(rows, params['$filter'])
+        if '$orderby' in params:
+            rows = self.order_rows(rows, params['$orderby'])
+
+        page_size = params['$pagesize']
+        page = params['$page']
+        start = (page - 1) * page_size
+        return FakeResponse({
+            'Data': rows[start:start + page_size],
+            'Meta': {'CurrentPage': page,
+                     'PageSize': page_size,
+                     'TotalNumberOfPages': -(-len(rows) // page_size),
+                     'TotalNumberOfResults': len(rows),
+                     'ServerTimeUtc': self.server_time}})
+
+    @staticmethod
+    def order_rows(rows, orderby):
+        """Order rows on $orderby, ex. Name desc,Code."""
+        rows = list(rows)
+        for order in reversed(orderby.split(',')):
+            key, _, direction = order.partition(' ')
+            rows.sort(key=lambda row: row[key], reverse=direction == 'desc')
+        return rows
+
+
+class FakeAsyncAPI(FakeAPI):
+
+    async def get(self, endpoint, params=None, **kwargs):
+        await asyncio.sleep(0)
+        return super().get(endpoint, params=params, **kwargs)
+
+
+@pytest.fixture()
+def swap_api(monkeypatch):
+    """
+    Return a function that sets the API of the manager of a model, ex.
+    swap_api(Unit, FakeAPI(rows)). The API is restored after the test.
+    """
+
+    def swap(model, api, is_async=False):
+        monkeypatch.setattr(model.objects,
+                            '_async_api' if is_async else '_api', api)
+        return api
+
+    return swap
+
+
+class Thing(VismaModel):
+    id = fields.UUID(data_key='Id')
+    name = fields.String(data_key='Name')
+    changed_utc = fields.DateTime(data_key='ChangedUtc', load_only=True)
+
+    class Meta:
+        endpoint = '/things'
+        allowed_methods = ['list']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+def make_thing(name, changed):
+    return {'Id': str(uuid.uuid4()), 'Name': name,
+            'ChangedUtc': changed.isoformat() + 'Z'}
+
+
+def filter_changed_since(rows, _filter):
+    """Only filters on ChangedUtc ge <datetime>."""
+    since = re.match(r'ChangedUtc ge (\S+)Z$', _filter).group(1)
+    return [row for row in rows if row['ChangedUtc'][:-1] >= since]
+
+
+@pytest.fixture()
+def thing_api(swap_api):
+    return swap_api(Thing, FakeAPI(filter_rows=filter_changed_since))
@@ -0,0 +1,236 @@
+import datetime
+import threading
+import time
+
+import pytest
+import requests
+
+from visma.api import VismaAPI, VismaAPIException, RetryPolicy, RateLimiter
+from visma.cache import SQLiteResponseCache
+
+
+def get_api(expires_in=3600, **kwargs):
+    expires = (datetime.datetime.now(tz=datetime.timezone.utc) +
+               datetime.timedelta(seconds=expires_in))
+    return VismaAPI('client_id', 'client_secret', access_token='access',
+                    refresh_token='refresh', token_expires=expires,
+                    **kwargs)
+
+
+def test_api_uses_pooled_session():
+    api = get_api(pool_maxsize=25)
+
+    adapter = api.session.get_adapter(api.API_URL)
+
+    assert adapter._pool_maxsize == 25
+    assert adapter._pool_connections == api.POOL_CONNECTIONS
+
+
+def test_api_close_with_context_manager():
+    with get_api() as api:
+        session = api.session
+
+    assert api.session is not session
+
+
+def test_api_without_keep_alive():
+    api = get_api(keep_alive=False)
+
+    assert api.session.headers['Connection'] == 'close'
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = b'{}'
+    return response
+
+
+class FakeSession:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = list()
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        response = self.responses.pop(0)
+        response.request = requests.Request(method, url).prepare()
+        return response
+
+
+def test_retry_on_too_many_requests():
+    retries = list()
+    api = get_api(retry=RetryPolicy(on_retry=lambda **kwargs: retries.append(
+        kwargs)))
+    api.session = FakeSession([make_response(429, {'Retry-After': '0'}),
+                               make_response(503, {'Retry-After': '0'}),
+                               make_response(200)])
+
+    response = api.get('/customers')
+
+    assert response.status_code == 200
+    assert [retry['attempt'] for retry in retries] == [1, 2]
+    assert [retry['delay'] for retry in retries] == [0, 0]
+
+
+def test_retry_gives_up_after_total_attempts():
+    api = get_api(retry=RetryPolicy(total=1, backoff_factor=0))
+    api.session = FakeSession([make_response(503), make_response(503)])
+
+    with pytest.raises(VismaAPIException):
+        api.get('/customers')
+
+    assert len(api.session.requests) == 2
+
+
+def test_post_is_not_retried():
+    api = get_api(retry=RetryPolicy(backoff_factor=0))
+    api.session = FakeSession([make_response(503), make_response(200)])
+
+    with pytest.raises(VismaAPIException):
+        api.post('/customers', '{}')
+
+    assert len(api.session.requests) == 1
+
+
+def test_backoff_is_capped():
+    retry = RetryPolicy(backoff_factor=1, max_backoff=5)
+
+    assert all(0 <= retry.get_backoff(10) <= 5 for _ in range(100))
+
+
+def test_rate_limiter_allows_burst_then_paces():
+    limiter = RateLimiter(rate=10, burst=2)
+
+    delays = [limiter.reserve() for _ in range(4)]
+
+    assert delays[:2] == [0, 0]
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_api_waits_for_rate_limiter():
+    class CountingLimiter:
+        calls = 0
+
+        def acquire(self):
+            self.calls += 1
+
+    limiter = CountingLimiter()
+    api = get_api(rate_limiter=limiter)
+    api.session = FakeSession([make_response(200), make_response(200)])
+
+    api.get('/customers')
+    api.delete('/customers/1')
+
+    assert limiter.calls == 2
+
+
+def fake_refresh(api, refreshes):
+
+    def _refresh_token():
+        time.sleep(0.05)
+        refreshes.append(api.access_token)
+        api.access_token = f'access-{len(refreshes)}'
+        api.token_expires = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                             datetime.timedelta(hours=1))
+
+    return _refresh_token
+
+
+def test_token_refreshed_once_before_expiry():
+    refreshes = list()
+    api = get_api(expires_in=30)
+    api._refresh_token = fake_refresh(api, refreshes)
+    api.session = FakeSession([make_response(200) for _ in range(5)])
+
+    threads = [threading.Thread(target=api.get, args=('/customers',))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert refreshes == ['access']
+    assert all(request[2]['headers']['Authorization'] == 'Bearer access-1'
+               for request in api.session.requests)
+
+
+def test_unauthorized_response_refreshes_token_and_retries_once():
+    refreshes = list()
+    api = get_api()
+    api._refresh_token = fake_refresh(api, refreshes)
+    api.session = FakeSession([make_response(401), make_response(401)])
+
+    with pytest.raises(VismaAPIException):
+        api.get('/customers')
+
+    assert refreshes == ['access']
+    assert len(api.session.requests) == 2
+
+
+def test_get_uses_response_cache(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'))
+    api = get_api(response_cache=cache)
+    api.session = FakeSession([make_response(200), make_response(200),
+                               make_response(200)])
+
+    api.get('/customers', params={'$page': 1})
+    api.get('/customers', params={'$page': 1})
+
+    assert len(api.session.requests) == 1
+
+    api.put('/customers/1', '{}')
+    api.get('/customers', params={'$page': 1})
+
+    assert len(api.session.requests) == 3
+
+
+def test_write_clears_responses_cached_while_it_is_sent(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'))
+    api = get_api(response_cache=cache)
+    api.session = FakeSession([make_response(200), make_response(200)])
+    key = cache.make_key(api._format_url('/customers'), {'$page': 1})
+    send = api.session.request
+
+    def request_while_get_caches_old_data(*args, **kwargs):
+        cache.set(key, make_response(200))
+        return send(*args, **kwargs)
+
+    api.session.request = request_while_get_caches_old_data
+    api.put('/customers/1', '{}')
+
+    assert cache.get(key) is None
+
+
+def test_conditional_get():
+    api = get_api()
+    first = make_response(200, {'ETag': '"v1"',
+                                'Last-Modified': 'Wed, 21 Oct 2026 07:28:00 GMT'})
+    api.session = FakeSession([first, make_response(304)])
+
+    api.get('/customerinvoicedrafts/1')
+    response = api.get('/customerinvoicedrafts/1')
+
+    headers = api.session.requests[1][2]['headers']
+    assert headers['If-None-Match'] == '"v1"'
+    assert headers['If-Modified-Since'] == 'Wed, 21 Oct 2026 07:28:00 GMT'
+    assert response is not first
+    assert type(first) is requests.Response
+    assert response.status_code == 200
+    assert response.content == first.content
+    assert response.headers['ETag'] == '"v1"'
+    assert response.json() is response.json()
+
+
+def test_conditional_get_only_for_same_params():
+    api = get_api()
+    api.session = FakeSession([make_response(200, {'ETag': '"v1"'}),
+                               make_response(200)])
+
+    api.get('/customers', params={'$page': 1})
+    api.get('/customers', params={'$page': 2})
+
+    assert 'If-None-Match' not in api.session.requests[1][2]['headers']
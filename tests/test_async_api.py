@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+
+import pytest
+
+web = pytest.importorskip('aiohttp.web')
+
+from visma.api import RetryPolicy, VismaAPIException
+from visma.async_api import AsyncVismaAPI
+
+
+def run_with_server(handler, test):
+    """Run test(api) against a local server answering with handler."""
+
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/v2/{tail:.*}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        expires = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                   datetime.timedelta(hours=1))
+        api = AsyncVismaAPI('client_id', 'client_secret',
+                            access_token='access', refresh_token='refresh',
+                            token_expires=expires,
+                            retry=RetryPolicy(backoff_factor=0))
+        api.API_URL = f'http://127.0.0.1:{port}/v2'
+        try:
+            async with api:
+                return await test(api)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_get():
+
+    async def handler(request):
+        assert request.headers['Authorization'] == 'Bearer access'
+        return web.json_response({'Id': request.match_info['tail'],
+                                  'Page': request.query['$page']})
+
+    async def test(api):
+        response = await api.get('/customers/1', params={'$page': 2})
+        return response.json()
+
+    assert run_with_server(handler, test) == {'Id': 'customers/1',
+                                              'Page': '2'}
+
+
+def test_retry_on_service_unavailable():
+    requests = list()
+
+    async def handler(request):
+        requests.append(request.method)
+        if len(requests) == 1:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.json_response({})
+
+    async def test(api):
+        return await api.put('/customers/1', '{}')
+
+    assert run_with_server(handler, test).status_code == 200
+    assert requests == ['PUT', 'PUT']
+
+
+def test_error_raises_exception():
+
+    async def handler(request):
+        return web.Response(status=400, text='Bad request')
+
+    async def test(api):
+        with pytest.raises(VismaAPIException):
+            await api.post('/customers', '{}')
+
+    run_with_server(handler, test)
+
+
+def test_conditional_get():
+    conditional_headers = list()
+
+    async def handler(request):
+        conditional_headers.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({'Id': 1}, headers={'ETag': '"v1"'})
+
+    async def test(api):
+        first = await api.get('/customerinvoicedrafts/1')
+        second = await api.get('/customerinvoicedrafts/1')
+        return first, second
+
+    first, second = run_with_server(handler, test)
+
+    assert conditional_headers == [None, '"v1"']
+    assert second is not first
+    assert second.status_code == 200
+    assert second.json() == {'Id': 1}
+
+
+def make_api():
+    return AsyncVismaAPI('client_id', 'client_secret',
+                         access_token='access', refresh_token='refresh',
+                         token_expires=datetime.datetime.now(
+                             tz=datetime.timezone.utc) +
+                         datetime.timedelta(hours=1))
+
+
+def test_session_from_closed_loop_is_closed():
+    api = make_api()
+    first = asyncio.run(api._get_async_session())
+    second = asyncio.run(api._get_async_session())
+
+    assert first.closed
+    assert second is not first
+    asyncio.run(second.close())
+
+
+def test_session_from_idle_loop_is_closed():
+    api = make_api()
+    loop = asyncio.new_event_loop()
+    try:
+        first = loop.run_until_complete(api._get_async_session())
+        second = asyncio.run(api._get_async_session())
+
+        assert first.closed
+        assert second is not first
+        asyncio.run(second.close())
+    finally:
+        loop.close()
+
+
+def test_session_is_reused_in_the_same_loop():
+
+    async def get_sessions(api):
+        first = await api._get_async_session()
+        second = await api._get_async_session()
+        await api.aclose()
+        return first, second
+
+    first, second = asyncio.run(get_sessions(make_api()))
+    assert first is second
@@ -0,0 +1,114 @@
+import time
+
+import requests
+
+from visma.cache import TTLCache, SQLiteResponseCache
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=None)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_ttl_expiry():
+    cache = TTLCache(ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+
+    assert cache.get('a', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def make_response(content):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = 'https://example.com/v2/customers'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = content
+    return response
+
+
+def test_response_cache_survives_restart(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    key = SQLiteResponseCache.make_key('https://example.com/v2/customers',
+                                       {'$page': 2, '$pagesize': 50})
+    cache = SQLiteResponseCache(path)
+    cache.set(key, make_response(b'{"Data": []}'))
+    cache.close()
+
+    response = SQLiteResponseCache(path).get(key)
+
+    assert response.json() == {'Data': []}
+    assert response.headers['Content-Type'] == 'application/json'
+
+
+def test_response_cache_key_ignores_param_order():
+    url = 'https://example.com/v2/customers'
+
+    assert (SQLiteResponseCache.make_key(url, {'$page': 1, '$filter': 'a'}) ==
+            SQLiteResponseCache.make_key(url, {'$filter': 'a', '$page': 1}))
+
+
+def test_response_cache_ttl(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'), ttl=0.01)
+    cache.set('key', make_response(b'{}'))
+    time.sleep(0.02)
+
+    assert cache.get('key') is None
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'), max_size=10)
+    cache.set('a', make_response(b'aaaa'))
+    cache.set('b', make_response(b'bbbb'))
+    cache.get('a')
+    cache.set('c', make_response(b'cccc'))
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+def test_response_cache_invalidate(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'))
+    cache.set('https://example.com/v2/customers?', make_response(b'{}'))
+    cache.set('https://example.com/v2/customers/1?', make_response(b'{}'))
+    cache.set('https://example.com/v2/articles?', make_response(b'{}'))
+
+    cache.invalidate('https://example.com/v2/customers')
+
+    assert cache.get('https://example.com/v2/customers?') is None
+    assert cache.get('https://example.com/v2/customers/1?') is None
+    assert cache.get('https://example.com/v2/articles?') is not None
+
+
+def test_response_cache_keeps_total_size(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = SQLiteResponseCache(path, max_size=10)
+
+    def total_size():
+        return cache._connection.execute(
+            'SELECT total FROM responses_size').fetchone()[0]
+
+    cache.set('https://example.com/v2/a?', make_response(b'aaaa'))
+    cache.set('https://example.com/v2/a?', make_response(b'aa'))
+    cache.set('https://example.com/v2/b?', make_response(b'bbbb'))
+    assert total_size() == 6
+
+    cache.set('https://example.com/v2/c?', make_response(b'cccccc'))
+    assert total_size() == 10
+
+    cache.invalidate('https://example.com/v2/c')
+    assert total_size() == 4
+    assert SQLiteResponseCache(path)._connection.execute(
+        'SELECT total FROM responses_size').fetchone()[0] == 4
+
+    cache.clear()
+    assert total_size() == 0
@@ -0,0 +1,86 @@
+import json
+import uuid
+
+import pytest
+
+from visma.api import VismaAPIException
+from visma.models import ArticleLabel
+from tests.conftest import FakeAPI, FakeResponse
+
+
+class FakeLabelAPI(FakeAPI):
+    """Stores article labels and fails on labels named 'fail'."""
+
+    def post(self, endpoint, data, **kwargs):
+        data = json.loads(data)
+        if data['Name'] == 'fail':
+            raise VismaAPIException('POST :: HTTP:400')
+        data['Id'] = str(uuid.uuid4())
+        with self.lock:
+            self.rows.append(data)
+        return FakeResponse(data)
+
+    def put(self, endpoint, data, **kwargs):
+        pk = endpoint.split('/')[-1]
+        data = json.loads(data)
+        data['Id'] = pk
+        with self.lock:
+            self.rows = [data if row['Id'] == pk else row
+                         for row in self.rows]
+        return FakeResponse(data)
+
+    def delete(self, endpoint, **kwargs):
+        pk = endpoint.split('/')[-1]
+        with self.lock:
+            rows = [row for row in self.rows if row['Id'] != pk]
+            if len(rows) == len(self.rows):
+                raise VismaAPIException('DELETE :: HTTP:404')
+            self.rows = rows
+        return FakeResponse(None)
+
+
+@pytest.fixture()
+def api(swap_api):
+    return swap_api(ArticleLabel, FakeLabelAPI())
+
+
+def test_bulk_create_collects_failures(api):
+    labels = [ArticleLabel(id=None, name=name, description='')
+              for name in ['first', 'fail', 'third']]
+
+    result = ArticleLabel.objects.bulk_create(labels, max_workers=2)
+
+    assert not result.ok
+    assert [obj.name for obj, _ in result.succeeded] == ['first', 'third']
+    assert [obj.name for obj, _ in result.failed] == ['fail']
+    assert isinstance(result.failed[0][1], VismaAPIException)
+    assert labels[0].id is not None
+    assert labels[1].id is None
+    assert len(api.rows) == 2
+
+
+def test_bulk_update(api):
+    labels = [ArticleLabel(id=None, name=f'label {i}', description='')
+              for i in range(5)]
+    ArticleLabel.objects.bulk_create(labels)
+    for label in labels:
+        label.description = 'updated'
+
+    result = ArticleLabel.objects.bulk_update(labels)
+
+    assert result.ok
+    assert all(label['Description'] == 'updated'
+               for label in api.rows)
+
+
+def test_bulk_delete(api):
+    labels = [ArticleLabel(id=None, name=f'label {i}', description='')
+              for i in range(3)]
+    ArticleLabel.objects.bulk_create(labels)
+    pks = [label.id for label in labels] + [uuid.uuid4()]
+
+    result = ArticleLabel.objects.bulk_delete(pks)
+
+    assert len(result.succeeded) == 3
+    assert [pk for pk, _ in result.failed] == [pks[-1]]
+    assert api.rows == []
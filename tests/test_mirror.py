@@ -0,0 +1,176 @@
+import datetime
+import uuid
+
+import pytest
+from marshmallow import fields
+
+from visma.base import VismaModel
+from visma.mirror import Mirror, get_mirrored_models
+from visma.models import Customer, PaginatedResponse, Unit
+from visma.query import Q
+from tests.conftest import Thing, make_thing
+
+
+class Gadget(VismaModel):
+    id = fields.UUID(data_key='Id')
+    name = fields.String(data_key='Name')
+    price = fields.Number(data_key='Price')
+    active = fields.Boolean(data_key='Active')
+    customer_id = fields.UUID(data_key='CustomerId', allow_none=True)
+    changed_utc = fields.DateTime(data_key='ChangedUtc', load_only=True)
+    tags = fields.List(fields.String(), data_key='Tags')
+
+    class Meta:
+        endpoint = '/gadgets'
+        allowed_methods = ['list']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+def make_gadget(name, price, active=True, changed=None, customer_id=None):
+    return Gadget(id=uuid.uuid4(), name=name, price=price, active=active,
+                  customer_id=customer_id, tags=[name, 'gadget'],
+                  changed_utc=changed or datetime.datetime(2018, 6, 1, 12))
+
+
+@pytest.fixture()
+def mirror(tmpdir):
+    gadget_mirror = Mirror(str(tmpdir.join('mirror.sqlite')))
+    gadget_mirror.save(Gadget, [
+        make_gadget('a', 10.0),
+        make_gadget('b', 20.5, active=False),
+        make_gadget('c', 30.0, changed=datetime.datetime(
+            2018, 6, 3, 12, tzinfo=datetime.timezone.utc)),
+    ])
+    yield gadget_mirror
+    gadget_mirror.close()
+
+
+def names(queryset):
+    return [gadget.name for gadget in queryset]
+
+
+def test_objects_keep_their_values(mirror):
+    gadget = mirror.objects(Gadget).filter(name='b').first()
+
+    assert gadget.price == 20.5
+    assert gadget.active is False
+    assert gadget.customer_id is None
+    assert gadget.tags == ['b', 'gadget']
+    assert gadget.changed_utc == datetime.datetime(2018, 6, 1, 12)
+
+
+def test_filter_exclude_and_order_by(mirror):
+    gadgets = mirror.objects(Gadget)
+
+    assert names(gadgets.filter(price__gt=15).order_by('name')) == ['b', 'c']
+    assert names(gadgets.exclude(name='a').order_by('name')) == ['b', 'c']
+    assert names(gadgets.filter(price__lte=20.5).exclude(
+        price__lt=20).order_by('name')) == ['b']
+    assert names(gadgets.filter(
+        changed_utc__gte=datetime.datetime(2018, 6, 2))) == ['c']
+
+
+def test_q_objects(mirror):
+    gadgets = mirror.objects(Gadget).order_by('name')
+
+    assert names(gadgets.filter(Q(name='a') | Q(price__gt=25))) == ['a', 'c']
+    assert names(gadgets.filter(Q(name='a') | Q(name='b'), price__lt=15)) == [
+        'a']
+    assert names(gadgets.exclude(Q(name='a') | Q(price__gt=25))) == ['b']
+
+
+def test_in_filter(mirror):
+    gadgets = mirror.objects(Gadget).order_by('name')
+    ids = [gadget.id for gadget in gadgets.filter(name__in=['a', 'c'])]
+
+    assert names(gadgets.filter(id__in=ids)) == ['a', 'c']
+    assert names(gadgets.exclude(id__in=ids)) == ['b']
+    assert names(gadgets.filter(id__in=[])) == []
+
+
+def test_string_functions(mirror):
+    mirror.save(Gadget, [make_gadget('Big_*Box', 1.0)])
+    gadgets = mirror.objects(Gadget).order_by('name')
+
+    assert names(gadgets.filter(name__contains='_*')) == ['Big_*Box']
+    assert names(gadgets.filter(name__contains='box')) == []
+    assert names(gadgets.filter(name__icontains='box')) == ['Big_*Box']
+    assert names(gadgets.filter(name__istartswith='BIG_')) == ['Big_*Box']
+    assert names(gadgets.filter(name__istartswith='BIGx')) == []
+    assert names(gadgets.filter(name__endswith='Box')) == ['Big_*Box']
+    assert names(gadgets.exclude(name__startswith='Big')) == ['a', 'b', 'c']
+
+
+def test_order_by_several_fields(mirror):
+    mirror.save(Gadget, [make_gadget('d', 20.5)])
+    gadgets = mirror.objects(Gadget)
+
+    assert names(gadgets.order_by('-price', 'name')) == ['c', 'b', 'd', 'a']
+    assert names(gadgets.order_by('-price', '-name')[:3]) == ['c', 'd', 'b']
+
+
+def test_values(mirror):
+    gadgets = mirror.objects(Gadget).order_by('name')
+
+    assert list(gadgets.values_list('name', flat=True)[:2]) == ['a', 'b']
+    assert gadgets.filter(name='b').values('price', 'tags')[0] == {
+        'price': 20.5, 'tags': ['b', 'gadget']}
+    assert gadgets.values_list('name', 'active')[1] == ('b', False)
+
+
+def test_count_and_slicing(mirror):
+    gadgets = mirror.objects(Gadget).order_by('name')
+
+    assert gadgets.count() == 3
+    assert gadgets.filter(price__gt=15).count() == 2
+    assert names(gadgets[1:]) == ['b', 'c']
+    assert names(gadgets[:2]) == ['a', 'b']
+    assert gadgets[2].name == 'c'
+    assert gadgets[1:].count() == 2
+
+
+def test_save_replaces_objects_by_id(mirror):
+    gadget = mirror.objects(Gadget).filter(name='a').first()
+    gadget.price = 99.0
+    mirror.save(Gadget, [gadget])
+
+    assert mirror.objects(Gadget).count() == 3
+    assert mirror.objects(Gadget).filter(name='a').first().price == 99.0
+
+
+def test_execute_joins(mirror):
+    mirror.execute('CREATE TABLE owners (id TEXT, name TEXT)')
+    gadget = mirror.objects(Gadget).filter(name='a').first()
+    mirror.execute('INSERT INTO owners VALUES (?, ?)', (str(gadget.id), 'me'))
+
+    assert mirror.execute(
+        'SELECT g.name, o.name FROM Gadget g JOIN owners o ON g.id = o.id'
+    ) == [('a', 'me')]
+
+
+def test_update_syncs_models_from_api(tmpdir, thing_api):
+    api = thing_api
+    api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    mirror = Mirror(str(tmpdir.join('mirror.sqlite')))
+    try:
+        assert mirror.update(models=[Thing]) == {Thing: 1}
+        api.rows.append(make_thing('b', datetime.datetime(2018, 6, 2, 12)))
+        # a is within the overlap and fetched again.
+        assert mirror.update(models=[Thing]) == {Thing: 2}
+        assert api.get_params('$filter')[-1] == (
+            'ChangedUtc ge 2018-06-01T11:55:00Z')
+        assert names(mirror.objects(Thing).order_by('name')) == ['a', 'b']
+
+        # A full update starts over and fetches everything.
+        assert mirror.update(models=[Thing], full=True) == {Thing: 2}
+        assert api.get_params('$filter')[-1] is None
+    finally:
+        mirror.close()
+
+
+def test_mirrored_models():
+    models = get_mirrored_models()
+
+    assert Customer in models
+    assert Unit in models
+    assert PaginatedResponse not in models
@@ -1,4 +1,11 @@
+import asyncio
+
+import pytest
+from marshmallow import fields
+
+from visma.base import VismaModel
 from visma.models import TermsOfPayment, CustomerInvoiceDraft
+from tests.conftest import FakeAPI, FakeAsyncAPI
 
 
 def test_customer_model_has_manager():
@@ -25,4 +32,84 @@ def test_model_endpoint():
 
 
 
+class CountingAPI:
+    loaded = 0
+
+    @classmethod
+    def load(cls):
+        cls.loaded += 1
+        return cls()
+
+
+def test_api_is_loaded_lazily_and_shared(monkeypatch):
+    from visma import manager
+    from visma.models import Customer
+
+    monkeypatch.setenv('VISMA_API_CLASS', 'tests.test_models.CountingAPI')
+    monkeypatch.setattr(manager, '_api_instances', dict())
+    monkeypatch.setattr(Customer.objects, '_api', None)
+    monkeypatch.setattr(TermsOfPayment.objects, '_api', None)
+
+    assert CountingAPI.loaded == 0
+
+    assert Customer.objects.api is TermsOfPayment.objects.api
+    assert CountingAPI.loaded == 1
+
+
+class SyncCountingAPI(CountingAPI, FakeAPI):
+    loaded = 0
+
+
+class AsyncCountingAPI(CountingAPI, FakeAsyncAPI):
+    loaded = 0
+
+
+def test_querysets_only_load_the_api_they_use(monkeypatch):
+    from visma import manager
+    from visma.models import Unit
+
+    monkeypatch.setenv('VISMA_API_CLASS', 'tests.test_models.SyncCountingAPI')
+    monkeypatch.setenv('VISMA_ASYNC_API_CLASS',
+                       'tests.test_models.AsyncCountingAPI')
+    monkeypatch.setattr(manager, '_api_instances', dict())
+    monkeypatch.setattr(Unit.objects, '_api', None)
+    monkeypatch.setattr(Unit.objects, '_async_api', None)
+
+    units = Unit.objects.filter(name='Box')
+    assert (SyncCountingAPI.loaded, AsyncCountingAPI.loaded) == (0, 0)
+
+    assert list(units) == []
+    assert (SyncCountingAPI.loaded, AsyncCountingAPI.loaded) == (1, 0)
+
+    async def fetch():
+        return [unit async for unit in Unit.objects.all()]
+
+    monkeypatch.setattr(manager, '_api_instances', dict())
+    monkeypatch.setattr(Unit.objects, '_api', None)
+    assert asyncio.run(fetch()) == []
+    assert (SyncCountingAPI.loaded, AsyncCountingAPI.loaded) == (1, 1)
+
+
+class Widget(VismaModel):
+    name = fields.String(data_key='Name')
+    tags = fields.List(fields.String(), data_key='Tags', default=[])
+    size = fields.Integer(data_key='Size', default=1)
+
+
+def test_field_defaults_are_set_per_instance():
+    first = Widget(name='first')
+    second = Widget(name='second', size=2)
+    first.tags.append('new')
+
+    assert (first.size, second.size) == (1, 2)
+    assert second.tags == []
+    assert Widget.tags.default == []
+    assert 'schema_fields' not in vars(first)
+
+
+def test_required_field_can_not_be_none():
+    with pytest.raises(AttributeError):
+        Widget(name=None)
+
+
 # TODO: test allowed methods. But how to do it without API access? Maybe need to mock the api?
\ No newline at end of file
@@ -0,0 +1,459 @@
+import asyncio
+import datetime
+import decimal
+import re
+import uuid
+from urllib.parse import urlencode
+
+import pytest
+
+from visma.api import VismaQueryCompiler
+from visma.models import Article, FiscalYear, Unit
+from visma.query import APIQuery, Filter, Q
+from tests.conftest import FakeAPI, FakeAsyncAPI
+
+
+def make_units(number_of_units):
+    return [{'Id': str(uuid.uuid4()), 'Name': f'Unit {i}',
+             'Code': f'U{i}', 'Abbreviation': f'u{i}'}
+            for i in range(number_of_units)]
+
+
+def filter_by_id(units, _filter):
+    """Only filters on Id eq <id> or Id eq <id> ..."""
+    ids = set(re.findall(r'Id eq ([0-9a-f-]+)', _filter))
+    return [unit for unit in units if unit['Id'] in ids]
+
+
+@pytest.fixture()
+def async_api(swap_api):
+    return swap_api(Unit, FakeAsyncAPI(make_units(120), filter_by_id),
+                    is_async=True)
+
+
+@pytest.fixture()
+def api(swap_api):
+    return swap_api(Unit, FakeAPI(make_units(120), filter_by_id))
+
+
+def test_iterate_all_pages(api):
+    units = list(Unit.objects.all())
+
+    assert [unit.name for unit in units] == [u['Name'] for u in api.rows]
+    assert [call['$page'] for call in api.calls] == [1, 2, 3]
+
+
+def test_prefetch_returns_pages_in_order(api):
+    units = list(Unit.objects.all().prefetch(max_workers=3))
+
+    assert [unit.name for unit in units] == [u['Name'] for u in api.rows]
+    assert sorted(call['$page'] for call in api.calls) == [1, 2, 3]
+
+
+def test_iterator_streams_without_result_cache(api):
+    queryset = Unit.objects.all()
+    iterator = queryset.iterator(chunk_size=40)
+
+    first = next(iterator)
+
+    assert first.name == api.rows[0]['Name']
+    assert len(api.calls) == 1
+    assert api.calls[0]['$pagesize'] == 40
+
+    rest = list(iterator)
+
+    assert len(rest) == len(api.rows) - 1
+    assert queryset._result_cache is None
+
+
+def test_index_fetches_single_object(api):
+    unit = Unit.objects.all()[0]
+
+    assert unit.name == api.rows[0]['Name']
+    assert api.calls == [{'$pagesize': 1, '$page': 1}]
+
+
+def test_slice_fetches_smallest_page(api):
+    units = list(Unit.objects.all()[5:10])
+
+    assert [unit.name for unit in units] == [u['Name'] for u in api.rows[5:10]]
+    assert api.calls == [{'$pagesize': 5, '$page': 2}]
+
+
+def test_slice_over_several_pages(api):
+    queryset = Unit.objects.all()[10:]
+    units = list(queryset[:60])
+
+    assert [unit.name for unit in units] == [u['Name'] for u in api.rows[10:70]]
+    assert api.calls == [{'$pagesize': 70, '$page': 1}]
+
+
+def test_first(api):
+    unit = Unit.objects.all().first()
+
+    assert unit.name == api.rows[0]['Name']
+    assert len(api.calls) == 1
+
+
+def test_index_out_of_range(api):
+    with pytest.raises(IndexError):
+        Unit.objects.all()[500]
+
+
+def test_count_reads_pagination_metadata(api):
+    queryset = Unit.objects.all()
+
+    assert queryset.count() == 120
+    assert len(queryset) == 120
+    assert queryset[100:].count() == 20
+    assert all(call['$pagesize'] == 1 for call in api.calls)
+    assert queryset._result_cache is None
+
+
+def test_exists(api):
+    assert Unit.objects.all().exists()
+    assert bool(Unit.objects.all()[120:]) is False
+    assert len(api.calls) == 2
+
+
+def test_async_iteration(async_api):
+
+    async def get_units():
+        return [unit async for unit in Unit.objects.all()]
+
+    units = asyncio.run(get_units())
+
+    assert [unit.name for unit in units] == [u['Name'] for u in async_api.rows]
+    assert sorted(call['$page'] for call in async_api.calls) == [1, 2, 3]
+
+
+def test_async_iterator_with_slice(async_api):
+
+    async def get_units():
+        queryset = Unit.objects.all()[45:105]
+        return [unit async for unit in queryset.aiterator()]
+
+    units = asyncio.run(get_units())
+
+    assert ([unit.name for unit in units] ==
+            [u['Name'] for u in async_api.rows[45:105]])
+
+
+@pytest.fixture()
+def cached_api(api, monkeypatch):
+    monkeypatch.setattr(Unit.objects, 'cache', None)
+    Unit.objects.enable_cache(ttl=60, maxsize=500)
+    return api
+
+
+def test_cache_serves_repeated_queries(cached_api):
+    units = list(Unit.objects.all())
+    calls = len(cached_api.calls)
+
+    assert [unit.id for unit in Unit.objects.all()] == [u.id for u in units]
+    assert Unit.objects.get(units[3].id) is units[3]
+    assert len(cached_api.calls) == calls
+
+    Unit.objects.invalidate_cache()
+    list(Unit.objects.all())
+
+    assert len(cached_api.calls) == 2 * calls
+
+
+def test_cache_keys_on_query(cached_api):
+    list(Unit.objects.all()[:10])
+    list(Unit.objects.all()[10:20])
+    list(Unit.objects.all()[:10])
+
+    assert len(cached_api.calls) == 2
+
+
+def test_chained_querysets_dont_share_filters(api):
+    units = Unit.objects.all()
+    units.filter(name='Unit 1').order_by('code')
+
+    assert units.query.filter_by == {}
+    assert units.query.order_by == []
+
+
+def compile_filter(model, *args, negate=False, **kwargs):
+    query = APIQuery(model=model, query_compiler=VismaQueryCompiler)
+    query.add_filter(negate, *args, **kwargs)
+    compiler = query.query_compiler(query)
+    compiler.compile()
+    return compiler.get_query_params().get('$filter')
+
+
+def test_filter_on_datetime():
+    changed = datetime.datetime(2018, 6, 1, 14, 30,
+                                tzinfo=datetime.timezone(
+                                    datetime.timedelta(hours=2)))
+
+    assert compile_filter(Article, changed_utc__gte=changed) == (
+        'ChangedUtc ge 2018-06-01T12:30:00Z')
+    assert compile_filter(
+        Article, changed_utc__lt=datetime.datetime(2018, 6, 1)) == (
+        'ChangedUtc lt 2018-06-01T00:00:00Z')
+
+
+def test_filter_on_date():
+    assert compile_filter(
+        FiscalYear, start_date__gte=datetime.date(2018, 1, 1)) == (
+        'StartDate ge 2018-01-01')
+    assert compile_filter(
+        FiscalYear, end_date=datetime.date(2018, 12, 31)) == (
+        'EndDate eq 2018-12-31')
+
+
+def test_filter_on_decimal():
+    assert compile_filter(Article, net_price__lte=decimal.Decimal('9.50')) == (
+        'NetPrice le 9.50')
+
+
+def test_filter_on_decimal_with_exponent():
+    assert compile_filter(Article, net_price__gt=decimal.Decimal('1E+2')) == (
+        'NetPrice gt 100')
+    assert compile_filter(
+        Article, net_price__gt=decimal.Decimal('0.0000001')) == (
+        'NetPrice gt 0.0000001')
+
+
+def test_filter_on_string_is_quoted():
+    assert compile_filter(Unit, name="Bob's") == "Name eq 'Bob''s'"
+    assert compile_filter(Unit, negate=True, name='Box') == "Name ne 'Box'"
+
+
+def test_exclude_comparisons_are_inverted():
+    assert compile_filter(Article, negate=True, net_price__gt=1) == (
+        'NetPrice le 1')
+    assert compile_filter(Article, negate=True, net_price__gte=1) == (
+        'NetPrice lt 1')
+    assert compile_filter(Article, negate=True, net_price__lt=1) == (
+        'NetPrice ge 1')
+    assert compile_filter(Article, negate=True, net_price__lte=1) == (
+        'NetPrice gt 1')
+
+
+def test_q_objects():
+    assert compile_filter(Unit, Q(name='a') | Q(name='b')) == (
+        "(Name eq 'a' or Name eq 'b')")
+    assert compile_filter(
+        Unit, (Q(name='a') | Q(name='b')) & Q(code='c'), abbreviation='d') == (
+        "Abbreviation eq 'd' and ((Name eq 'a' or Name eq 'b') and "
+        "Code eq 'c')")
+    assert compile_filter(Unit, Q(code='c', name='a')) == (
+        "(Code eq 'c' and Name eq 'a')")
+    assert compile_filter(Unit, Q()) is None
+
+
+def test_negated_q_objects_use_de_morgan():
+    assert compile_filter(Unit, ~(Q(name='a') | Q(name='b'))) == (
+        "(Name ne 'a' and Name ne 'b')")
+    assert compile_filter(Article, ~Q(net_price__gt=1, name='a')) == (
+        "(Name ne 'a' or NetPrice le 1)")
+    assert compile_filter(Unit, Q(name='a') | Q(name='b'), negate=True) == (
+        "(Name ne 'a' and Name ne 'b')")
+    assert compile_filter(Unit, ~~Q(name='a')) == "Name eq 'a'"
+
+
+def test_filter_with_q_on_queryset(api):
+    units = Unit.objects.filter(Q(name='Unit 1') | Q(name='Unit 2'))
+    list(units)
+
+    assert api.calls[0]['$filter'] == "(Name eq 'Unit 1' or Name eq 'Unit 2')"
+
+
+def test_in_filter():
+    ids = [uuid.UUID(int=1), uuid.UUID(int=2)]
+
+    assert compile_filter(Unit, id__in=ids) == (
+        f'(Id eq {ids[0]} or Id eq {ids[1]})')
+    assert compile_filter(Unit, id__in=ids, negate=True) == (
+        f'(Id ne {ids[0]} and Id ne {ids[1]})')
+    assert compile_filter(Unit, name__in=['a'], code='b') == (
+        "Name eq 'a' and Code eq 'b'")
+    assert compile_filter(Unit, Q(name__in=[]) | Q(code='b')) == (
+        "(false or Code eq 'b')")
+
+    with pytest.raises(ValueError):
+        compile_filter(Unit, id__in=[object()])
+
+
+@pytest.fixture()
+def many_units_api(api):
+    api.rows = [{'Id': str(uuid.uuid4()), 'Name': f'Unit {i:03}',
+                 'Code': f'U{i}', 'Abbreviation': f'u{i}'}
+                for i in range(300)]
+    return api
+
+
+def test_long_in_filter_is_split_into_batches(many_units_api):
+    api = many_units_api
+    ids = [unit['Id'] for unit in api.rows]
+
+    units = list(Unit.objects.filter(id__in=ids + ids[:10]))
+
+    assert len(api.calls) > 1
+    assert all(len(urlencode({'$filter': call['$filter']})) <= 1800
+               for call in api.calls)
+    assert [str(unit.id) for unit in units] == ids
+
+
+def test_batches_are_merged_in_order_and_sliced(many_units_api):
+    api = many_units_api
+    ids = [unit['Id'] for unit in reversed(api.rows)]
+
+    units = Unit.objects.filter(id__in=ids).order_by('name')
+
+    assert [unit.name for unit in units[5:8]] == [
+        'Unit 005', 'Unit 006', 'Unit 007']
+    assert units.count() == 300
+    assert units[290:].count() == 10
+
+
+def test_batches_are_merged_in_value_order(many_units_api, monkeypatch):
+    ids = [unit['Id'] for unit in reversed(many_units_api.rows)]
+    monkeypatch.setattr(Unit.objects, 'supports_select', True)
+
+    units = Unit.objects.filter(id__in=ids)
+    names = Unit.objects.all().values_list('name', flat=True).filter(
+        id__in=ids)
+
+    assert [str(unit.id) for unit in units] == ids
+    assert list(names[:2]) == ['Unit 299', 'Unit 298']
+    assert many_units_api.calls[-1]['$select'] == 'Name,Id'
+
+
+def test_async_long_in_filter(async_api):
+    ids = [unit['Id'] for unit in async_api.rows] * 30
+
+    async def fetch():
+        return [unit async for unit in Unit.objects.filter(id__in=ids)]
+
+    units = asyncio.run(fetch())
+
+    assert len(async_api.calls) > 1
+    assert [str(unit.id) for unit in units] == ids[:120]
+
+
+def test_string_functions():
+    assert compile_filter(Unit, name__contains="Bob's") == (
+        "substringof('Bob''s', Name)")
+    assert compile_filter(Unit, name__icontains='BoB') == (
+        "substringof('bob', tolower(Name))")
+    assert compile_filter(Unit, name__startswith='Da') == (
+        "startswith(Name, 'Da')")
+    assert compile_filter(Unit, name__iendswith='VE') == (
+        "endswith(tolower(Name), 've')")
+    assert compile_filter(Unit, name__contains='a', negate=True) == (
+        "substringof('a', Name) eq false")
+    assert compile_filter(Unit, ~Q(name__istartswith='A') | Q(code='b')) == (
+        "(startswith(tolower(Name), 'a') eq false or Code eq 'b')")
+
+    with pytest.raises(ValueError):
+        compile_filter(Unit, name__contains=1)
+
+
+def compile_order(model, *field_names):
+    query = APIQuery(model=model, query_compiler=VismaQueryCompiler)
+    query.add_ordering(*field_names)
+    compiler = query.query_compiler(query)
+    compiler.compile()
+    return compiler.get_query_params()['$orderby']
+
+
+def test_order_by_several_fields():
+    assert compile_order(Unit, 'name') == 'Name'
+    assert compile_order(Article, '-changed_utc', 'name') == (
+        'ChangedUtc desc,Name')
+
+
+def test_order_by_replaces_ordering(api):
+    units = Unit.objects.all().order_by('code').order_by('-name', 'code')
+    list(units[:5])
+
+    assert units.query.order_by == ['-name', 'code']
+    assert api.calls[0]['$orderby'] == 'Name desc,Code'
+    assert Unit.objects.all().order_by('name').order_by().query.order_by == []
+
+
+def test_batches_are_merged_in_descending_order(many_units_api):
+    ids = [unit['Id'] for unit in many_units_api.rows]
+
+    units = Unit.objects.filter(id__in=ids).order_by('-name')[:3]
+
+    assert [unit.name for unit in units] == [
+        'Unit 299', 'Unit 298', 'Unit 297']
+
+
+def test_compiled_queries_are_reused(monkeypatch):
+    VismaQueryCompiler.template_cache.clear()
+    validated = list()
+    original_validate = Filter.validate
+    monkeypatch.setattr(Filter, 'validate', lambda self: (
+        validated.append(self.key), original_validate(self))[1])
+
+    def compile_units(name, codes):
+        return compile_filter(Unit, Q(name=name) | Q(code__in=codes),
+                              abbreviation__startswith=name)
+
+    assert compile_units('a', ['b']) == (
+        "startswith(Abbreviation, 'a') and (Name eq 'a' or Code eq 'b')")
+    assert compile_units('c', ['d', 'e']) == (
+        "startswith(Abbreviation, 'c') and "
+        "(Name eq 'c' or (Code eq 'd' or Code eq 'e'))")
+    assert validated == ['abbreviation', 'name', 'code']
+
+    # Another value type is another shape and is validated again.
+    with pytest.raises(ValueError):
+        compile_units('a', [1.5j])
+
+
+def test_values(api, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('values() should not create units')
+    monkeypatch.setattr(Unit, '__init__', fail)
+
+    units = Unit.objects.all()
+    first = api.rows[0]
+
+    assert units.values('id', 'name')[0] == {'id': uuid.UUID(first['Id']),
+                                            'name': first['Name']}
+    assert units.values_list('name', 'code')[0] == (first['Name'],
+                                                    first['Code'])
+    assert list(units.values_list('name', flat=True)) == [
+        unit['Name'] for unit in api.rows]
+    assert set(units.values()[0]) == {'id', 'name', 'code', 'abbreviation'}
+    assert '$select' not in api.calls[-1]
+
+    with pytest.raises(TypeError):
+        units.values_list('name', 'code', flat=True)
+    with pytest.raises(ValueError):
+        units.values('size')
+
+
+def test_values_selects_fields_when_supported(api, monkeypatch):
+    monkeypatch.setattr(Unit.objects, 'supports_select', True)
+
+    list(Unit.objects.all().values('name'))
+    assert api.calls[-1]['$select'] == 'Name'
+
+    list(Unit.objects.all().values_list('name').order_by('-code'))
+    assert api.calls[-1]['$select'] == 'Name,Code'
+
+
+def test_values_with_batches(many_units_api):
+    ids = [unit['Id'] for unit in many_units_api.rows]
+
+    names = Unit.objects.filter(id__in=ids).order_by('-name').values_list(
+        'name', flat=True)
+
+    assert list(names[:3]) == ['Unit 299', 'Unit 298', 'Unit 297']
+
+
+def test_async_values(async_api):
+    async def fetch():
+        return [name async for name in Unit.objects.all().values_list(
+            'name', flat=True)]
+
+    assert asyncio.run(fetch()) == [unit['Name'] for unit in async_api.rows]
@@ -0,0 +1,120 @@
+import datetime
+
+import pytest
+
+from visma.api import VismaClientException
+from visma.models import Unit
+from visma.sync import SQLiteSyncStore, SyncEngine
+from tests.conftest import Thing, make_thing
+
+
+@pytest.fixture()
+def store(tmpdir):
+    sync_store = SQLiteSyncStore(str(tmpdir.join('sync.sqlite')))
+    yield sync_store
+    sync_store.close()
+
+
+def test_first_sync_fetches_all(thing_api, store):
+    thing_api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    thing_api.rows.append(make_thing('b', datetime.datetime(2018, 6, 2, 12)))
+
+    assert SyncEngine(store).sync(Thing) == 2
+    assert thing_api.get_params('$filter') == [None]
+    assert store.get_high_water_mark(Thing) == datetime.datetime(
+        2018, 6, 2, 12, tzinfo=datetime.timezone.utc)
+    assert sorted(thing.name for thing in store.get_objects(Thing)) == [
+        'a', 'b']
+
+
+def test_next_sync_fetches_changed_since_high_water_mark(thing_api, store):
+    engine = SyncEngine(store, overlap=datetime.timedelta(minutes=5))
+    thing_api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    thing_api.rows.append(make_thing('b', datetime.datetime(2018, 6, 2, 12)))
+    engine.sync(Thing)
+
+    thing_api.rows.append(make_thing('c', datetime.datetime(2018, 6, 3, 12)))
+
+    # b is within the overlap and fetched again.
+    assert engine.sync(Thing) == 2
+    assert thing_api.get_params('$filter')[-1] == (
+        'ChangedUtc ge 2018-06-02T11:55:00Z')
+    assert store.get_high_water_mark(Thing) == datetime.datetime(
+        2018, 6, 3, 12, tzinfo=datetime.timezone.utc)
+    assert len(store.get_objects(Thing)) == 3
+
+
+def test_sync_pages_in_change_order(thing_api, store):
+    thing_api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    SyncEngine(store).sync(Thing)
+
+    assert thing_api.get_params('$orderby') == ['ChangedUtc']
+
+
+def test_objects_changed_during_sync_do_not_hide_others(thing_api, store):
+    for day, name in enumerate('ABCD', start=1):
+        thing_api.rows.append(
+            make_thing(name, datetime.datetime(2018, 6, day, 12)))
+    get = thing_api.get
+
+    def get_and_change_a(endpoint, params=None, **kwargs):
+        response = get(endpoint, params=params, **kwargs)
+        if len(thing_api.calls) == 1:
+            # A moves to the end once the first chunk is served.
+            thing_api.rows[0] = dict(thing_api.rows[0],
+                                     ChangedUtc='2018-06-10T12:00:00Z')
+        return response
+
+    thing_api.get = get_and_change_a
+
+    assert SyncEngine(store, chunk_size=2).sync(Thing) == 5
+    assert sorted(thing.name for thing in store.get_objects(Thing)) == [
+        'A', 'B', 'C', 'D']
+    assert store.get_high_water_mark(Thing) == datetime.datetime(
+        2018, 6, 10, 12, tzinfo=datetime.timezone.utc)
+
+
+def test_objects_with_the_same_timestamp_are_all_fetched(thing_api, store):
+    for name in 'ABCDE':
+        thing_api.rows.append(
+            make_thing(name, datetime.datetime(2018, 6, 1, 12)))
+
+    assert SyncEngine(store, chunk_size=2).sync(Thing) == 5
+    assert len(store.get_objects(Thing)) == 5
+
+
+def test_high_water_mark_is_not_after_server_time(thing_api, store):
+    thing_api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    # Changed on a server with a clock ahead of the one serving the pages.
+    thing_api.rows.append(make_thing('b', datetime.datetime(2018, 6, 30, 12)))
+
+    SyncEngine(store).sync(Thing)
+
+    assert store.get_high_water_mark(Thing) == datetime.datetime(
+        2018, 6, 21, 16, 23, 13, tzinfo=datetime.timezone.utc)
+
+
+def test_full_sync_ignores_high_water_mark(thing_api, store):
+    engine = SyncEngine(store)
+    thing_api.rows.append(make_thing('a', datetime.datetime(2018, 6, 1, 12)))
+    engine.sync(Thing)
+
+    assert engine.sync(Thing, full=True) == 1
+    assert thing_api.get_params('$filter') == [None, None]
+
+
+def test_stored_objects_keep_their_values(thing_api, store):
+    thing_api.rows.append(
+        make_thing('a', datetime.datetime(2018, 6, 1, 12, 30)))
+    SyncEngine(store).sync(Thing)
+
+    thing, = store.get_objects(Thing)
+    assert str(thing.id) == thing_api.rows[0]['Id']
+    assert thing.name == 'a'
+    assert thing.changed_utc.replace(tzinfo=None) == datetime.datetime(
+        2018, 6, 1, 12, 30)
+
+
+def test_model_without_timestamp_field(store):
+    with pytest.raises(VismaClientException):
+        SyncEngine(store).sync(Unit)
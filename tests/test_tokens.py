@@ -0,0 +1,65 @@
+import datetime
+
+from visma.api import VismaAPI
+from visma.tokens import JSONFileTokenStore
+
+
+def in_seconds(seconds):
+    return (datetime.datetime.now(tz=datetime.timezone.utc) +
+            datetime.timedelta(seconds=seconds))
+
+
+def get_api(store):
+    tokens = store.load()
+    return VismaAPI('client_id', 'client_secret',
+                    access_token=tokens['access_token'],
+                    refresh_token=tokens['refresh_token'],
+                    token_expires=tokens['expires'],
+                    token_store=store)
+
+
+def test_save_and_load(tmp_path):
+    store = JSONFileTokenStore(str(tmp_path / 'tokens.json'))
+    expires = in_seconds(3600)
+
+    store.save({'access_token': 'access', 'refresh_token': 'refresh',
+                'expires': expires})
+
+    assert store.load() == {'access_token': 'access',
+                            'refresh_token': 'refresh',
+                            'expires': expires}
+    assert [path.name for path in tmp_path.iterdir()] == ['tokens.json']
+
+
+def test_load_missing_file(tmp_path):
+    store = JSONFileTokenStore(str(tmp_path / 'tokens.json'))
+
+    assert store.load() is None
+
+
+def test_refresh_uses_tokens_refreshed_by_other_process(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    JSONFileTokenStore(path).save({'access_token': 'access',
+                                   'refresh_token': 'refresh',
+                                   'expires': in_seconds(3600)})
+    first = get_api(JSONFileTokenStore(path))
+    second = get_api(JSONFileTokenStore(path))
+    requested = list()
+
+    def request_new_token(api):
+        def _request_new_token():
+            requested.append(api.refresh_token)
+            api.access_token = 'new-access'
+            api.refresh_token = 'new-refresh'
+            api.token_expires = in_seconds(3600)
+        return _request_new_token
+
+    first._request_new_token = request_new_token(first)
+    second._request_new_token = request_new_token(second)
+
+    first._refresh_token()
+    second._refresh_token()
+
+    assert requested == ['refresh']
+    assert second.access_token == 'new-access'
+    assert JSONFileTokenStore(path).load()['refresh_token'] == 'new-refresh'
@@ -1,63 +1,198 @@
-import json
 import datetime
-import iso8601
+import decimal
+import random
+import threading
+import time
 import requests
+from email.utils import parsedate_to_datetime
 from os import environ
 
+from requests.adapters import HTTPAdapter
+
 from marshmallow import fields
 
-from visma.query import QueryCompiler, FilterParser
+from visma.cache import (SQLiteResponseCache, TTLCache, CachedResponse,
+                         make_cache_key)
+from visma.query import QueryCompiler, FilterParser, OrderBy
+from visma.tokens import JSONFileTokenStore
+from visma.utils import import_string
 
 
-class GreaterThanFilterParser(FilterParser):
+def format_value(value, field=None):
+    """
+    Format value as an OData literal for a filter on field. Datetimes are
+    converted to UTC, naive datetimes are assumed to be in UTC already.
+    Strings are quoted when filtering on string fields.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None)
+        return value.isoformat() + 'Z'
 
-    def parse(self):
-        return f'{self.field.data_key} gt {self.value}'
+    if isinstance(value, datetime.date):
+        return value.isoformat()
 
+    if isinstance(value, decimal.Decimal):
+        # str() uses exponents, ex. 1E+2, which OData doesn't accept.
+        return format(value, 'f')
 
-class GreaterOrEqualThanFilterParser(FilterParser):
+    if (isinstance(value, str) and isinstance(field, fields.String) and
+            not isinstance(field, fields.UUID)):
+        return quote_string(value)
 
-    def parse(self):
-        return f'{self.field.data_key} ge {self.value}'
+    return str(value)
 
 
-class LessThanFilterParser(FilterParser):
+def quote_string(value):
+    """Return value as an OData string literal."""
+    escaped = value.replace("'", "''")
+    return f"'{escaped}'"
+
+
+class ODataFilterParser(FilterParser):
+    operator = None
 
     def parse(self):
-        return f'{self.field.data_key} lt {self.value}'
+        return (f'{self.field.data_key} {self.operator} '
+                f'{format_value(self.value, self.field)}')
 
 
-class LessOrEqualThanFilterParser(FilterParser):
+class GreaterThanFilterParser(ODataFilterParser):
+    operator = 'gt'
 
-    def parse(self):
-        return f'{self.field.data_key} le {self.value}'
+
+class GreaterOrEqualThanFilterParser(ODataFilterParser):
+    operator = 'ge'
 
 
-class EqualFilterParser(FilterParser):
+class LessThanFilterParser(ODataFilterParser):
+    operator = 'lt'
+
+
+class LessOrEqualThanFilterParser(ODataFilterParser):
+    operator = 'le'
+
+
+class EqualFilterParser(ODataFilterParser):
+    operator = 'eq'
+
+
+class NotEqualFilterParser(ODataFilterParser):
+    operator = 'ne'
+
+
+class InFilterParser(ODataFilterParser):
+    """
+    OData has no in operator so the values are compared one by one and
+    joined with or.
+    """
+    operator = 'eq'
+    connector = 'or'
+    # The result of an empty list of values.
+    empty = 'false'
 
     def parse(self):
-        if isinstance(self.field, fields.UUID):
-            return f'{self.field.data_key} eq {self.value}'
+        clauses = [f'{self.field.data_key} {self.operator} '
+                   f'{format_value(value, self.field)}'
+                   for value in self.value]
+        if not clauses:
+            return self.empty
+        if len(clauses) == 1:
+            return clauses[0]
+        return '(' + f' {self.connector} '.join(clauses) + ')'
 
-        elif isinstance(self.field, fields.String):
-            return f'{self.field.data_key} eq \'{self.value}\''
 
-        else:
-            return f'{self.field.data_key} eq {self.value}'
+class NotInFilterParser(InFilterParser):
+    operator = 'ne'
+    connector = 'and'
+    empty = 'true'
+
 
+class StringFunctionFilterParser(FilterParser):
+    """
+    Filters with an OData string function, ex. startswith(Name, 'Da').
+    Case insensitive variants compare the lower case field with the lower
+    case value. Negated filters compare the result with false.
+    """
+    function = None
+    case_insensitive = False
+    negate = False
 
-class NotEqualFilterParser(FilterParser):
+    def get_arguments(self, field, value):
+        return f'{field}, {value}'
 
     def parse(self):
-        if isinstance(self.value, str):
-            return f'{self.field.data_key} ne {self.value}'
-        else:
-            return f'{self.field.data_key} ne {self.value}'
+        field = self.field.data_key
+        value = self.value
+        if self.case_insensitive:
+            field = f'tolower({field})'
+            value = value.lower()
+
+        expression = (f'{self.function}('
+                      f'{self.get_arguments(field, quote_string(value))})')
+        if self.negate:
+            return f'{expression} eq false'
+        return expression
+
+
+class ContainsFilterParser(StringFunctionFilterParser):
+    function = 'substringof'
+
+    def get_arguments(self, field, value):
+        # substringof takes the substring first.
+        return f'{value}, {field}'
+
+
+class NotContainsFilterParser(ContainsFilterParser):
+    negate = True
+
+
+class IContainsFilterParser(ContainsFilterParser):
+    case_insensitive = True
+
+
+class NotIContainsFilterParser(IContainsFilterParser):
+    negate = True
+
+
+class StartsWithFilterParser(StringFunctionFilterParser):
+    function = 'startswith'
+
+
+class NotStartsWithFilterParser(StartsWithFilterParser):
+    negate = True
+
+
+class IStartsWithFilterParser(StartsWithFilterParser):
+    case_insensitive = True
+
+
+class NotIStartsWithFilterParser(IStartsWithFilterParser):
+    negate = True
+
+
+class EndsWithFilterParser(StringFunctionFilterParser):
+    function = 'endswith'
+
+
+class NotEndsWithFilterParser(EndsWithFilterParser):
+    negate = True
+
+
+class IEndsWithFilterParser(EndsWithFilterParser):
+    case_insensitive = True
+
+
+class NotIEndsWithFilterParser(IEndsWithFilterParser):
+    negate = True
 
 
 class OrderByFilterParser(FilterParser):
 
     def parse(self):
+        if self.value == OrderBy.DESCENDING:
+            return f'{self.field.data_key} desc'
         return self.field.data_key
 
 
@@ -68,7 +203,24 @@ class VismaQueryCompiler(QueryCompiler):
     greater_or_equal_parser_class = GreaterOrEqualThanFilterParser
     less_than_parser_class = LessThanFilterParser
     less_or_equal_parser_class = LessOrEqualThanFilterParser
+    in_parser_class = InFilterParser
+    not_in_parser_class = NotInFilterParser
+    contains_parser_class = ContainsFilterParser
+    not_contains_parser_class = NotContainsFilterParser
+    icontains_parser_class = IContainsFilterParser
+    not_icontains_parser_class = NotIContainsFilterParser
+    startswith_parser_class = StartsWithFilterParser
+    not_startswith_parser_class = NotStartsWithFilterParser
+    istartswith_parser_class = IStartsWithFilterParser
+    not_istartswith_parser_class = NotIStartsWithFilterParser
+    endswith_parser_class = EndsWithFilterParser
+    not_endswith_parser_class = NotEndsWithFilterParser
+    iendswith_parser_class = IEndsWithFilterParser
+    not_iendswith_parser_class = NotIEndsWithFilterParser
     order_by_parser_class = OrderByFilterParser
+    # IIS rejects query strings longer than 2048 characters by default.
+    # Leave room for the other parameters.
+    max_filter_length = 1800
 
 
 class VismaAPIException(Exception):
@@ -81,6 +233,136 @@ class VismaClientException(Exception):
     pass
 
 
+class RetryPolicy:
+    """
+    Decides if and when a failed request to the API should be retried.
+
+    Requests are retried on connection errors and on the status codes in
+    status_codes. Only idempotent methods are retried unless
+    retry_non_idempotent is set. The wait between attempts is an exponential
+    backoff with full jitter, capped at max_backoff, unless the response has a
+    Retry-After header in which case that is used.
+
+    :param int total: Number of retries before giving up.
+    :param float backoff_factor: Base of the exponential backoff in seconds.
+    :param float max_backoff: Maximum time to wait between attempts.
+    :param status_codes: HTTP status codes that should be retried.
+    :param methods: HTTP methods that are safe to retry.
+    :param bool retry_non_idempotent: Retry all methods, ex. POST.
+    :param bool respect_retry_after: Use the Retry-After header if present.
+    :param on_retry: Callable called before each retry with the keyword
+        arguments method, url, attempt, delay, response and exception. Use
+        it to monitor retries.
+    """
+    RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    def __init__(self, total=3, backoff_factor=0.5, max_backoff=30,
+                 status_codes=None, methods=None, retry_non_idempotent=False,
+                 respect_retry_after=True, on_retry=None):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.status_codes = frozenset(status_codes or self.RETRY_STATUS_CODES)
+        self.methods = frozenset(methods or self.IDEMPOTENT_METHODS)
+        self.retry_non_idempotent = retry_non_idempotent
+        self.respect_retry_after = respect_retry_after
+        self.on_retry = on_retry
+
+    def should_retry(self, method, attempt, response=None, exception=None):
+        """
+        Return True if the request should be made again. attempt is the
+        number of retries already made.
+        """
+        if attempt >= self.total:
+            return False
+
+        if not self.retry_non_idempotent and method not in self.methods:
+            return False
+
+        if exception is not None:
+            return True
+
+        return response.status_code in self.status_codes
+
+    def get_backoff(self, attempt, response=None):
+        """Return the number of seconds to wait before the next attempt."""
+        if self.respect_retry_after and response is not None:
+            retry_after = self.parse_retry_after(
+                response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after
+
+        backoff = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        return random.uniform(0, backoff)
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Retry-After can be either a number of seconds or a HTTP date.
+        """
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            retry_date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        return max(0.0, (retry_date - now).total_seconds())
+
+    def notify(self, **kwargs):
+        if self.on_retry is not None:
+            self.on_retry(**kwargs)
+
+
+class RateLimiter:
+    """
+    Client side token bucket rate limiter. Allows rate requests per second on
+    average with bursts of up to burst requests. The limiter is thread safe so
+    one instance can be shared by all threads using the same credentials.
+
+    When the bucket is empty callers wait for their turn instead of failing.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token from the bucket and return the number of seconds the
+        caller has to wait before it may make its request. Tokens are
+        reserved in call order so waiting callers are served first come,
+        first served.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Wait until a request may be made."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
 class VismaAPI:
     """
     Class containing methods to interact with the Visma E-Accounting API
@@ -94,9 +376,24 @@ class VismaAPI:
 
     QUERY_COMPILER_CLASS = VismaQueryCompiler
 
+    # Connection pool defaults. pool_connections is the number of hosts to
+    # keep pools for and pool_maxsize the number of connections kept alive
+    # per host.
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 10
+
+    # Number of responses kept in memory for conditional requests.
+    CONDITIONAL_CACHE_SIZE = 256
+
+    # Refresh the access token this long before it expires.
+    TOKEN_REFRESH_MARGIN = datetime.timedelta(seconds=60)
+
     def __init__(self, client_id, client_secret,
                  access_token, refresh_token, token_expires, token_path=None,
-                 test=False):
+                 test=False, pool_connections=None, pool_maxsize=None,
+                 pool_block=False, keep_alive=True, retry=None,
+                 rate_limiter=None, token_store=None, response_cache=None,
+                 conditional_cache_size=None):
 
         self.client_id = client_id
         self.client_secret = client_secret
@@ -106,45 +403,221 @@ class VismaAPI:
         self.token_path = token_path
         self.test = test
 
+        if token_store is None and token_path is not None:
+            token_store = JSONFileTokenStore(token_path)
+        self.token_store = token_store
+
+        self.pool_connections = pool_connections or self.POOL_CONNECTIONS
+        self.pool_maxsize = pool_maxsize or self.POOL_MAXSIZE
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.session = self._create_session()
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+
+        if conditional_cache_size is None:
+            conditional_cache_size = self.CONDITIONAL_CACHE_SIZE
+        self.conditional_cache = (
+            TTLCache(maxsize=conditional_cache_size, ttl=None)
+            if conditional_cache_size else None)
+
+        # Only one thread at a time may refresh the token since the refresh
+        # token can only be used once.
+        self._token_lock = threading.Lock()
+
         if self.token_expired:
             self._refresh_token()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _create_session(self):
+        """
+        Create the session used for all requests. The session keeps
+        connections alive between requests so we don't need to do a new
+        TCP and TLS handshake for every call to the API.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+
+        return session
+
+    def close(self):
+        """
+        Close all pooled connections. A new pool is created if the API is
+        used again after it has been closed.
+        """
+        self.session.close()
+        self.session = self._create_session()
+
     # TODO: Can I make a decorator to handle errors from the API?
 
     def get(self, endpoint, params=None, **kwargs):
-        url = self._format_url(endpoint)
-        headers = self.api_headers
-
-        r = requests.get(url, params, headers=headers, **kwargs)
-        if not r.ok:
+        cache_key = make_cache_key(self._format_url(endpoint), params)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        headers, validated = self._get_conditional_headers(cache_key)
+        r = self._request('GET', endpoint, params=params, headers=headers,
+                          **kwargs)
+        if r.status_code == 304 and validated is not None:
+            r = CachedResponse.from_response(validated)
+        elif not r.ok:
             raise VismaAPIException(
                 f'GET {r.request.url} :: HTTP:{r.status_code}, {r.content}')
+        else:
+            self._set_validated(cache_key, r)
+
+        if self.response_cache is not None:
+            self.response_cache.set(cache_key, r)
         return r
 
-    def post(self, endpoint, data, *args, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.post(url, data, *args, headers=self.api_headers, **kwargs)
+    def post(self, endpoint, data, **kwargs):
+        self._invalidate_cache(endpoint)
+        try:
+            r = self._request('POST', endpoint, data=data, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
         if not r.ok:
             raise VismaAPIException(
                 f'POST :: HTTP:{r.status_code}, {r.content}')
         return r
 
     def put(self, endpoint, data, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.put(url, data, headers=self.api_headers, **kwargs)
+        self._invalidate_cache(endpoint)
+        try:
+            r = self._request('PUT', endpoint, data=data, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
         if not r.ok:
             raise VismaAPIException(
                 f'PUT :: HTTP:{r.status_code}, {r.content}')
         return r
 
     def delete(self, endpoint, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.delete(url, headers=self.api_headers, **kwargs)
+        self._invalidate_cache(endpoint)
+        try:
+            r = self._request('DELETE', endpoint, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
         if not r.ok:
             raise VismaAPIException(
                 f'DELETE :: HTTP:{r.status_code}, {r.content}')
         return r
 
+    def _get_conditional_headers(self, cache_key):
+        """
+        Return the conditional headers for a GET on cache_key and the
+        response they were taken from. If the API answers 304 Not Modified
+        that response is still valid.
+        """
+        if self.conditional_cache is None:
+            return None, None
+
+        validated = self.conditional_cache.get(cache_key)
+        if validated is None:
+            return None, None
+
+        headers = dict()
+        if 'ETag' in validated.headers:
+            headers['If-None-Match'] = validated.headers['ETag']
+        if 'Last-Modified' in validated.headers:
+            headers['If-Modified-Since'] = validated.headers['Last-Modified']
+        return headers, validated
+
+    def _set_validated(self, cache_key, response):
+        """
+        Keep a copy of responses with an ETag or Last-Modified header so the
+        next GET of the same resource can be conditional. Each 304 gets its
+        own copy of the kept response.
+        """
+        if self.conditional_cache is None:
+            return
+
+        if ('ETag' not in response.headers and
+                'Last-Modified' not in response.headers):
+            return
+
+        self.conditional_cache.set(cache_key,
+                                   CachedResponse.from_response(response))
+
+    def _invalidate_cache(self, endpoint):
+        """
+        Remove cached responses for the collection the endpoint belongs to,
+        ex. /customers/{id} removes everything under /customers.
+        """
+        if self.response_cache is None:
+            return
+        collection = '/' + endpoint.strip('/').split('/')[0]
+        self.response_cache.invalidate(self._format_url(collection))
+
+    def _request(self, method, endpoint, headers=None, **kwargs):
+        """
+        Make a request to the API. Failed requests are retried according to
+        the retry policy. The last response is returned when we give up and
+        the last exception is raised if there never was a response.
+        headers are sent in addition to the API headers.
+        """
+        url = self._format_url(endpoint)
+        attempt = 0
+        reauthenticated = False
+
+        while True:
+            response = None
+            exception = None
+
+            self._ensure_valid_token()
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            request_headers = self.api_headers
+            request_headers.update(headers or {})
+            try:
+                response = self.session.request(method, url,
+                                                headers=request_headers,
+                                                **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                exception = e
+
+            if (response is not None and response.status_code == 401 and
+                    not reauthenticated):
+                # The token might have been revoked or expired early. Get a
+                # new one and try once more.
+                reauthenticated = True
+                self._refresh_token_if_unchanged(
+                    request_headers['Authorization'])
+                continue
+
+            if not self.retry.should_retry(method, attempt, response=response,
+                                           exception=exception):
+                if exception is not None:
+                    raise exception
+                return response
+
+            delay = self.retry.get_backoff(attempt, response=response)
+            attempt += 1
+            self.retry.notify(method=method, url=url, attempt=attempt,
+                              delay=delay, response=response,
+                              exception=exception)
+            time.sleep(delay)
+
     def _format_url(self, endpoint):
         if self.test:
             url = self.API_URL_TEST + endpoint
@@ -168,7 +641,56 @@ class VismaAPI:
         else:
             return False
 
+    @property
+    def token_expires_soon(self):
+        refresh_at = self.token_expires - self.TOKEN_REFRESH_MARGIN
+        return datetime.datetime.now(tz=datetime.timezone.utc) > refresh_at
+
+    def _ensure_valid_token(self):
+        """
+        Refresh the access token if it is about to expire. Threads that need
+        a new token while another thread is refreshing it wait for that
+        refresh instead of making their own.
+        """
+        if not self.token_expires_soon:
+            return
+
+        with self._token_lock:
+            if self.token_expires_soon:
+                self._refresh_token()
+
+    def _refresh_token_if_unchanged(self, authorization):
+        """
+        Refresh the access token after the API rejected it, unless another
+        thread already has refreshed it since the request was made.
+        """
+        with self._token_lock:
+            if self.api_headers['Authorization'] == authorization:
+                self._refresh_token()
+
     def _refresh_token(self):
+        """
+        Get a new access token. If the tokens are kept in a token store they
+        are refreshed while holding the store's lock. If another process has
+        refreshed the tokens already we use those instead of spending our
+        refresh token, which has already been used.
+        """
+        if self.token_store is None:
+            self._request_new_token()
+            return
+
+        with self.token_store.lock():
+            tokens = self.token_store.load()
+            if (tokens is not None and
+                    tokens['refresh_token'] != self.refresh_token):
+                self._set_tokens(tokens)
+                if not self.token_expires_soon:
+                    return
+
+            self._request_new_token()
+            self._save_tokens()
+
+    def _request_new_token(self):
 
         if self.test:
             url = self.TOKEN_URL_TEST
@@ -180,9 +702,9 @@ class VismaAPI:
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
         }
-        response = requests.post(url, data,
-                                 auth=(self.client_id, self.client_secret),
-                                 headers=headers)
+        response = self.session.post(url, data,
+                                     auth=(self.client_id, self.client_secret),
+                                     headers=headers)
 
         if response.status_code != 200:
             raise VismaAPIException(f'Couldn\'t refresh token: '
@@ -201,33 +723,32 @@ class VismaAPI:
             expires = now + expiry_time
             self.token_expires = expires
 
-        self._save_tokens()
+    def _set_tokens(self, tokens):
+        self.access_token = tokens['access_token']
+        self.refresh_token = tokens['refresh_token']
+        self.token_expires = tokens['expires']
 
     def _load_tokens(self):
         """
-        Load tokens from json file
+        Load tokens from the token store
         """
-        with open(self.token_path) as cred_file:
-            tokens = json.load(cred_file)
-            self.access_token = tokens['access_token']
-            self.refresh_token = tokens['refresh_token']
-            self.token_expires = iso8601.parse_date(tokens['expires'])
+        tokens = self.token_store.load()
+        if tokens is not None:
+            self._set_tokens(tokens)
 
     def _save_tokens(self):
         """
-        Save tokens to json file
+        Save tokens to the token store
         """
         tokens = {'access_token': self.access_token,
                   'refresh_token': self.refresh_token,
-                  'expires': self.token_expires.isoformat()}
-
-        with open(self.token_path, 'w') as token_file:
-            json.dump(tokens, token_file)
+                  'expires': self.token_expires}
+        self.token_store.save(tokens)
 
     @classmethod
     def load(cls):
         """
-        Load tokens from json file
+        Load tokens from the token store
         """
 
         env = cls.get_api_settings_from_env()
@@ -235,25 +756,37 @@ class VismaAPI:
         access_token = None
         refresh_token = None
         token_expires = None
+        token_store = None
 
         if env['token_path'] is not None:
+            token_store_klass = import_string(env['token_store_class'])
+            token_store = token_store_klass(env['token_path'])
 
-            with open(env['token_path']) as token_file:
-                tokens = json.load(token_file)
+            tokens = token_store.load()
+            if tokens is not None:
                 access_token = tokens['access_token']
                 refresh_token = tokens['refresh_token']
-                token_expires = iso8601.parse_date(tokens['expires'])
+                token_expires = tokens['expires']
 
         return cls(env['client_id'], env['client_secret'],
                    access_token=access_token,
                    refresh_token=refresh_token,
                    token_expires=token_expires,
                    token_path=env['token_path'],
-                   test=env['test'])
+                   test=env['test'],
+                   pool_connections=env['pool_connections'],
+                   pool_maxsize=env['pool_maxsize'],
+                   retry=env['retry'],
+                   rate_limiter=env['rate_limiter'],
+                   token_store=token_store,
+                   response_cache=env['response_cache'])
 
     @staticmethod
     def get_api_settings_from_env():
         settings = {'token_path': environ.get('VISMA_API_TOKEN_PATH'),
+                    'token_store_class': environ.get(
+                        'VISMA_API_TOKEN_STORE',
+                        default='visma.tokens.JSONFileTokenStore'),
                     'client_id': environ.get('VISMA_API_CLIENT_ID'),
                     'client_secret': environ.get('VISMA_API_CLIENT_SECRET')}
 
@@ -263,6 +796,36 @@ class VismaAPI:
         else:
             settings['test'] = False
 
+        pool_connections = environ.get('VISMA_API_POOL_CONNECTIONS')
+        settings['pool_connections'] = (int(pool_connections)
+                                        if pool_connections else None)
+        pool_maxsize = environ.get('VISMA_API_POOL_MAXSIZE')
+        settings['pool_maxsize'] = int(pool_maxsize) if pool_maxsize else None
+
+        max_retries = environ.get('VISMA_API_MAX_RETRIES')
+        settings['retry'] = (RetryPolicy(total=int(max_retries))
+                             if max_retries else None)
+
+        rate_limit = environ.get('VISMA_API_RATE_LIMIT')
+        rate_burst = environ.get('VISMA_API_RATE_BURST')
+        settings['rate_limiter'] = (
+            RateLimiter(float(rate_limit),
+                        burst=int(rate_burst) if rate_burst else None)
+            if rate_limit else None)
+
+        cache_path = environ.get('VISMA_API_CACHE_PATH')
+        settings['response_cache'] = None
+        if cache_path:
+            cache_ttl = environ.get('VISMA_API_CACHE_TTL')
+            cache_max_size = environ.get('VISMA_API_CACHE_MAX_SIZE')
+            cache_settings = dict()
+            if cache_ttl:
+                cache_settings['ttl'] = float(cache_ttl)
+            if cache_max_size:
+                cache_settings['max_size'] = int(cache_max_size)
+            settings['response_cache'] = SQLiteResponseCache(cache_path,
+                                                             **cache_settings)
+
         return settings
 
 class NoAPI:
@@ -0,0 +1,218 @@
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from visma.api import VismaAPI, VismaAPIException, VismaClientException
+from visma.cache import CachedResponse, make_cache_key
+
+
+class AsyncResponse:
+    """
+    The parts of an aiohttp response that we use. The body is read before
+    the connection is released so it can be used like a requests response.
+    """
+
+    def __init__(self, response, content):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        # The content can't change so the body is only parsed once.
+        if not hasattr(self, '_json'):
+            self._json = json.loads(self.content)
+        return self._json
+
+
+class AsyncVismaAPI(VismaAPI):
+    """
+    Async version of :class:`VismaAPI` using aiohttp. get, post, put and
+    delete are coroutines, otherwise it is set up and configured the same
+    way. Token refresh, retries and rate limiting work as in the sync API.
+
+    Requires aiohttp. Install with pip install visma[async]
+    """
+
+    def __init__(self, *args, **kwargs):
+        if aiohttp is None:
+            raise VismaClientException('aiohttp is required to use '
+                                       'AsyncVismaAPI')
+        self._async_session = None
+        self._async_session_loop = None
+        super().__init__(*args, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def _get_async_session(self):
+        """
+        Return the aiohttp session. It is bound to the event loop it is
+        created in, so a new one is created if we are called from another
+        loop and the old one is closed.
+        """
+        loop = asyncio.get_running_loop()
+        session = self._async_session
+        if (session is None or session.closed or
+                self._async_session_loop is not loop):
+            stale_session = session
+            stale_loop = self._async_session_loop
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_connections * self.pool_maxsize,
+                limit_per_host=self.pool_maxsize,
+                force_close=not self.keep_alive)
+            self._async_session = aiohttp.ClientSession(connector=connector)
+            self._async_session_loop = loop
+            if stale_session is not None and not stale_session.closed:
+                await self._close_stale_session(stale_session, stale_loop)
+        return self._async_session
+
+    @staticmethod
+    async def _close_stale_session(session, loop):
+        """
+        Close a session created in another event loop. Its connections
+        belong to that loop, so they are closed in it.
+        """
+        if loop.is_closed():
+            # The connections can't be used anymore, this only marks the
+            # session and its connector as closed.
+            await session.close()
+        elif loop.is_running():
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(session.close(), loop))
+        else:
+            await asyncio.get_running_loop().run_in_executor(
+                None, loop.run_until_complete, session.close())
+
+    async def aclose(self):
+        """Close all connections in the async connection pool."""
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+        self.close()
+
+    async def get(self, endpoint, params=None, **kwargs):
+        cache_key = make_cache_key(self._format_url(endpoint), params)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        headers, validated = self._get_conditional_headers(cache_key)
+        r = await self._request('GET', endpoint, params=params,
+                                headers=headers, **kwargs)
+        if r.status_code == 304 and validated is not None:
+            r = CachedResponse.from_response(validated)
+        elif not r.ok:
+            raise VismaAPIException(
+                f'GET {r.url} :: HTTP:{r.status_code}, {r.content}')
+        else:
+            self._set_validated(cache_key, r)
+
+        if self.response_cache is not None:
+            self.response_cache.set(cache_key, r)
+        return r
+
+    async def post(self, endpoint, data, **kwargs):
+        self._invalidate_cache(endpoint)
+        try:
+            r = await self._request('POST', endpoint, data=data, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
+        if not r.ok:
+            raise VismaAPIException(
+                f'POST :: HTTP:{r.status_code}, {r.content}')
+        return r
+
+    async def put(self, endpoint, data, **kwargs):
+        self._invalidate_cache(endpoint)
+        try:
+            r = await self._request('PUT', endpoint, data=data, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
+        if not r.ok:
+            raise VismaAPIException(
+                f'PUT :: HTTP:{r.status_code}, {r.content}')
+        return r
+
+    async def delete(self, endpoint, **kwargs):
+        self._invalidate_cache(endpoint)
+        try:
+            r = await self._request('DELETE', endpoint, **kwargs)
+        finally:
+            # A GET while the request was sent might have cached old data.
+            self._invalidate_cache(endpoint)
+        if not r.ok:
+            raise VismaAPIException(
+                f'DELETE :: HTTP:{r.status_code}, {r.content}')
+        return r
+
+    async def _request(self, method, endpoint, headers=None, **kwargs):
+        """
+        Async version of :meth:`VismaAPI._request`. Token refreshes are run
+        in the default executor using the same locks as the sync API, so
+        only one refresh is in flight even when sync and async code share
+        the tokens.
+        """
+        session = await self._get_async_session()
+        loop = asyncio.get_running_loop()
+        url = self._format_url(endpoint)
+        attempt = 0
+        reauthenticated = False
+
+        while True:
+            response = None
+            exception = None
+
+            if self.token_expires_soon:
+                await loop.run_in_executor(None, self._ensure_valid_token)
+
+            if self.rate_limiter is not None:
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            request_headers = self.api_headers
+            request_headers.update(headers or {})
+            try:
+                async with session.request(method, url,
+                                           headers=request_headers,
+                                           **kwargs) as r:
+                    content = await r.read()
+                    response = AsyncResponse(r, content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                exception = e
+
+            if (response is not None and response.status_code == 401 and
+                    not reauthenticated):
+                reauthenticated = True
+                await loop.run_in_executor(None,
+                                           self._refresh_token_if_unchanged,
+                                           request_headers['Authorization'])
+                continue
+
+            if not self.retry.should_retry(method, attempt, response=response,
+                                           exception=exception):
+                if exception is not None:
+                    raise exception
+                return response
+
+            delay = self.retry.get_backoff(attempt, response=response)
+            attempt += 1
+            self.retry.notify(method=method, url=url, attempt=attempt,
+                              delay=delay, response=response,
+                              exception=exception)
+            await asyncio.sleep(delay)
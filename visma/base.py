@@ -1,12 +1,11 @@
 import copy
-import os
 
 from marshmallow import Schema, post_load, fields
 from marshmallow.base import FieldABC
 from marshmallow.utils import _Missing
 
 from visma.manager import Manager
-from visma.utils import is_instance_or_subclass, import_string
+from visma.utils import is_instance_or_subclass
 
 
 class VismaSchema(Schema):
@@ -27,6 +26,25 @@ def _get_fields(attrs, field_class):
     return fields
 
 
+def _get_field_defaults(schema_items):
+    """
+    Return (field_name, default, copy_default, allow_none) for each field.
+    The fields are shared by all instances of a model, so this is done once
+    per class instead of on every __init__. Mutable defaults, like an empty
+    list of rows, are copied for each instance.
+    """
+    field_defaults = list()
+    for field_name, field_value in schema_items.items():
+        default = field_value.default
+        if is_instance_or_subclass(default, _Missing):
+            default = None
+        copy_default = isinstance(default, (list, dict, set))
+        allow_none = field_value.allow_none or field_value.load_only
+        field_defaults.append((field_name, default, copy_default, allow_none))
+
+    return tuple(field_defaults)
+
+
 class VismaModelMeta(type):
     """Base metaclass for all VismaModels"""
 
@@ -50,6 +68,8 @@ class VismaModelMeta(type):
         schema_name = name + 'Schema'
         schema_dict = dict(schema_attrs)
         new_class._schema_items = dict(schema_attrs)
+        new_class._field_defaults = _get_field_defaults(
+            new_class._schema_items)
         schema_dict['visma_model'] = new_class
 
         schema_klass = type(schema_name, (VismaSchema,), schema_dict)
@@ -72,11 +92,6 @@ class VismaModelMeta(type):
             manager.allowed_methods = [method.upper() for method in
                                        allowed_methods]
 
-            api_klass_path = os.environ.get('VISMA_API_CLASS',
-                                            default='visma.api.NoAPI')
-            api_klass = import_string(api_klass_path)
-            manager.api = api_klass.load()
-
             new_class.objects = manager
 
             envelopes = getattr(meta, 'envelopes', dict())
@@ -100,14 +115,21 @@ class VismaModelMeta(type):
                                          })
                 manager.register_envelope(envelope_method, sub_envelop_klass)
 
+            manager.supports_select = getattr(meta, 'supports_select', False)
+
+            cache_settings = getattr(meta, 'cache', None)
+            if cache_settings is not None:
+                manager.enable_cache(**cache_settings)
+
         return new_class
 
 
 class VismaModel(metaclass=VismaModelMeta):
     id = None
+    _schema_items = dict()
+    _field_defaults = tuple()
 
     def __init__(self, *args, **kwargs):
-        self.schema_fields = copy.deepcopy(self._schema_items)
         # TODO: go throuhg and create all items and fill them with data.
 
         # There is two ways to create the object. Either directly suing
@@ -130,17 +152,20 @@ class VismaModel(metaclass=VismaModelMeta):
         # checking if all fields exept the load only has been filled. And alos
         # check if allow_none is on the field.
 
+    @property
+    def schema_fields(self):
+        return self._schema_items
+
     def _init_fields(self, kwargs=None):
 
-        for field_name, field_value in self.schema_fields.items():
-            try:
+        for field_name, default, copy_default, allow_none in (
+                self._field_defaults):
+            if field_name in kwargs:
                 value = kwargs[field_name]
-            except KeyError:
-                value = field_value.default
-                if is_instance_or_subclass(value, _Missing):
-                    value = None
-
-            allow_none = field_value.allow_none or field_value.load_only
+            elif copy_default:
+                value = copy.copy(default)
+            else:
+                value = default
 
             if value is None and not allow_none:
                 raise AttributeError(
@@ -155,7 +180,7 @@ class VismaModel(metaclass=VismaModelMeta):
             return
 
         else:
-            for field_name, field_value in self.schema_fields.items():
+            for field_name in self._schema_items:
                 value = getattr(obj, field_name)
                 setattr(self, field_name, value)
 
@@ -174,6 +199,19 @@ class VismaModel(metaclass=VismaModelMeta):
     def delete(self):
         self.objects.delete(self.id)
 
+    async def asave(self):
+
+        if self.id is None:
+            new_obj = await self.objects.acreate(self)
+            self._update_value(obj=new_obj)
+
+        else:
+            updated_obj = await self.objects.aupdate(self)
+            self._update_value(obj=updated_obj)
+
+    async def adelete(self):
+        await self.objects.adelete(self.id)
+
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self)
 
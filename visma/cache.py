@@ -0,0 +1,227 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+
+
+def make_cache_key(url, params=None):
+    """Key for a request on url with params, independent of param order."""
+    params = sorted((str(key), str(value))
+                    for key, value in (params or {}).items())
+    return f'{url}?{urlencode(params)}'
+
+
+class CachedResponse(requests.Response):
+    """
+    A response served from a cache. The JSON body is only parsed once, so
+    callers get the same parsed data and should not change it.
+    """
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        Return a copy of response with its url, headers and content. Works
+        for both requests and async responses.
+        """
+        return cls.build(response.url, response.content,
+                         dict(response.headers), response.status_code)
+
+    @classmethod
+    def build(cls, url, content, headers, status_code=200):
+        response = cls()
+        response.status_code = status_code
+        response.url = url
+        response._content = content
+        response.headers.update(headers)
+        return response
+
+    def json(self, **kwargs):
+        if not hasattr(self, '_json'):
+            self._json = super().json(**kwargs)
+        return self._json
+
+
+class TTLCache:
+    """
+    Thread safe in-memory cache with a time to live and a LRU size bound.
+
+    :param int maxsize: Maximum number of entries. The least recently used
+        entry is evicted when the cache is full.
+    :param float ttl: Seconds an entry is valid. None means forever.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteResponseCache:
+    """
+    Persistent cache of API responses in a SQLite database.
+
+    Responses are keyed on the url and the query parameters, ex. $filter,
+    $orderby, $page and $pagesize. Entries older than ttl seconds are not
+    used and the least recently used entries are removed when the cached
+    responses take up more than max_size bytes.
+
+    The key doesn't include the credentials, so use one cache file per
+    company.
+
+    :param str path: Path to the database file.
+    :param float ttl: Seconds a response is valid. None means forever.
+    :param int max_size: Maximum total size in bytes of cached responses.
+    """
+
+    def __init__(self, path, ttl=3600, max_size=100 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        with self._lock:
+            # The total size is kept up to date by triggers, so it doesn't
+            # need to be summed on every insert. Rows replaced by INSERT OR
+            # REPLACE only fire the delete trigger with recursive triggers.
+            self._connection.execute('PRAGMA recursive_triggers = ON')
+            # Other processes sharing the file must not insert between
+            # summing the sizes and creating the triggers.
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, url TEXT, content BLOB, headers TEXT, '
+                'created REAL, accessed REAL, size INTEGER)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed '
+                'ON responses (accessed)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses_size ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)')
+            self._connection.execute(
+                'INSERT OR IGNORE INTO responses_size (id, total) '
+                'SELECT 0, COALESCE(SUM(size), 0) FROM responses')
+            self._connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS responses_insert '
+                'AFTER INSERT ON responses BEGIN '
+                'UPDATE responses_size SET total = total + NEW.size; END')
+            self._connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS responses_delete '
+                'AFTER DELETE ON responses BEGIN '
+                'UPDATE responses_size SET total = total - OLD.size; END')
+            self._connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS responses_update '
+                'AFTER UPDATE OF size ON responses BEGIN '
+                'UPDATE responses_size '
+                'SET total = total + NEW.size - OLD.size; END')
+            self._connection.execute('COMMIT')
+
+    make_key = staticmethod(make_cache_key)
+
+    def get(self, key):
+        """Return the cached response for key or None."""
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT url, content, headers, created FROM responses '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            url, content, headers, created = row
+            if self.ttl is not None and created + self.ttl < now:
+                self._connection.execute('DELETE FROM responses WHERE key = ?',
+                                         (key,))
+                return None
+
+            self._connection.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+
+        return CachedResponse.build(url, content, json.loads(headers))
+
+    def set(self, key, response):
+        """Cache a successful response."""
+        now = time.time()
+        content = response.content
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, url, content, headers, created, accessed, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, content, json.dumps(dict(response.headers)),
+                 now, now, len(content)))
+            self._evict()
+
+    def _evict(self):
+        total_size = self._connection.execute(
+            'SELECT total FROM responses_size').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        # Only read the least recently used entries we need to remove.
+        keys = list()
+        cursor = self._connection.execute(
+            'SELECT key, size FROM responses ORDER BY accessed')
+        for key, size in cursor:
+            if total_size <= self.max_size:
+                break
+            keys.append((key,))
+            total_size -= size
+        cursor.close()
+        self._connection.executemany('DELETE FROM responses WHERE key = ?',
+                                     keys)
+
+    def invalidate(self, url_prefix):
+        """Remove all responses for urls starting with url_prefix."""
+        escaped = (url_prefix.replace('\\', '\\\\').replace('%', '\\%')
+                   .replace('_', '\\_'))
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key LIKE ? ESCAPE '\\'",
+                (escaped + '%',))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
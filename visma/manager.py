@@ -1,24 +1,148 @@
 import json
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from visma.api import VismaClientException
-from visma.query import APIQuerySet
+from visma.cache import TTLCache
+from visma.query import APIQuery, APIQuerySet
+from visma.utils import import_string
 
 logger = logging.getLogger(__name__)
 
+# Loaded API instances by class path. All managers using the same API class
+# share one instance and thereby one connection pool.
+_api_instances = dict()
+_api_lock = threading.Lock()
+
+
+def get_api_klass_path(env_variable='VISMA_API_CLASS'):
+    return os.environ.get(env_variable, default='visma.api.NoAPI')
+
+
+def get_api(api_klass_path=None):
+    """
+    Return the shared API instance of the class given by api_klass_path or
+    the VISMA_API_CLASS environment variable. The API is loaded the first
+    time it is asked for.
+    """
+    if api_klass_path is None:
+        api_klass_path = get_api_klass_path()
+
+    with _api_lock:
+        api = _api_instances.get(api_klass_path)
+        if api is None:
+            api_klass = import_string(api_klass_path)
+            api = api_klass.load()
+            _api_instances[api_klass_path] = api
+
+    return api
+
+
+class BulkResult:
+    """
+    The outcome of a bulk operation on a manager.
+
+    succeeded is a list of (item, result) and failed a list of
+    (item, exception), both in the order the items were given.
+    """
+
+    def __init__(self):
+        self.succeeded = list()
+        self.failed = list()
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__}: {len(self.succeeded)} succeeded, '
+                f'{len(self.failed)} failed>')
+
 
 class Manager:
+    # Number of concurrent requests used by the bulk operations.
+    BULK_MAX_WORKERS = 4
 
     def __init__(self):
         self.model = None
         self.name = None
         self.endpoint = None
-        self.api = None
+        self._api = None
+        self._async_api = None
+        self.cache = None
+        # If the endpoint supports $select, values() only asks for the
+        # fields it needs.
+        self.supports_select = False
         self.allowed_methods = list()
         self.schema = None
         self._schema = None
         self.envelopes = dict()
 
+    @property
+    def api(self):
+        """
+        The API used by the manager. It is resolved on first use so importing
+        the models doesn't load tokens or make any requests.
+        """
+        if self._api is None:
+            self._api = get_api()
+        return self._api
+
+    @api.setter
+    def api(self, api):
+        self._api = api
+
+    @property
+    def async_api(self):
+        """
+        The API used by the async methods, given by VISMA_ASYNC_API_CLASS.
+        Ex visma.async_api.AsyncVismaAPI
+        """
+        if self._async_api is None:
+            self._async_api = get_api(
+                get_api_klass_path('VISMA_ASYNC_API_CLASS'))
+        return self._async_api
+
+    @async_api.setter
+    def async_api(self, api):
+        self._async_api = api
+
+    @property
+    def query_compiler_class(self):
+        """
+        The query compiler of the APIs. It is read from the API classes, so
+        no API is loaded to build a query.
+        """
+        for api, env_variable in ((self._api, 'VISMA_API_CLASS'),
+                                  (self._async_api, 'VISMA_ASYNC_API_CLASS')):
+            if api is None:
+                api = import_string(get_api_klass_path(env_variable))
+            query_compiler = getattr(api, 'QUERY_COMPILER_CLASS', None)
+            if query_compiler is not None:
+                return query_compiler
+        return None
+
+    def enable_cache(self, ttl=3600, maxsize=256):
+        """
+        Cache the results of get(), all() and filter() in memory. Meant for
+        reference data that rarely changes, ex. VatCode or Unit. Cached
+        objects are shared between callers.
+
+        :param float ttl: Seconds a result is cached. None means forever.
+        :param int maxsize: Maximum number of cached results.
+        """
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def invalidate_cache(self):
+        """Remove all cached results."""
+        if self.cache is not None:
+            self.cache.clear()
+
     def register_model(self, model, name):
         self.name = self.name or name
         self.model = model
@@ -40,7 +164,12 @@ class Manager:
         return method in self.envelopes.keys()
 
     def _get_query_set(self, *args, **kwargs):
-        return APIQuerySet(model=self.model, api=self.api, schema=self.schema,
+        # The querysets get the APIs from the manager when they need them,
+        # so iterating only loads the API that is used.
+        query = APIQuery(model=self.model,
+                         query_compiler=self.query_compiler_class)
+        return APIQuerySet(model=self.model, api=None, schema=self.schema,
+                           query=query, cache=self.cache, manager=self,
                            *args, **kwargs)
 
     def all(self):
@@ -51,30 +180,44 @@ class Manager:
         else:
             return self._get_query_set()
 
-    def filter(self, **kwargs):
+    def filter(self, *args, **kwargs):
         return self._get_query_set(envelope=self.envelopes['LIST']).filter(
-            **kwargs)
+            *args, **kwargs)
 
-    def exclude(self, **kwargs):
+    def exclude(self, *args, **kwargs):
         return self._get_query_set(envelope=self.envelopes['LIST']).exclude(
-            **kwargs)
+            *args, **kwargs)
 
     # TODO: Should get, create update and delete also return querysets?
     # Then need to implement the handling of them
 
     def get(self, pk, method='GET'):
         self.verify_method(method)
+        obj = self._get_cached(pk)
+        if obj is not None:
+            return obj
         _endpoint = f'{self.endpoint}/{pk}'
         data = self.api.get(_endpoint).json()
         logger.debug(f'Received: {data}')
         obj = self.schema.load(data)
+        self._set_cached(pk, obj)
         return obj
 
+    def _get_cached(self, pk):
+        if self.cache is None:
+            return None
+        return self.cache.get(('get', str(pk)))
+
+    def _set_cached(self, pk, obj):
+        if self.cache is not None:
+            self.cache.set(('get', str(pk)), obj)
+
     def create(self, obj, method='CREATE'):
         self.verify_method(method)
         out_data = self.schema.dump(obj)
         logger.debug(f'Sending: {out_data}')
         result = self.api.post(self.endpoint, json.dumps(out_data))
+        self.invalidate_cache()
         in_data = result.json()
         logger.debug(f'Received {in_data}')
         new_obj = self.schema.load(in_data)
@@ -87,6 +230,7 @@ class Manager:
         out_data = self.schema.dump(obj)
         logger.debug(f'Sending {out_data}')
         result = self.api.put(_endpoint, json.dumps(out_data))
+        self.invalidate_cache()
         in_data = result.json()
         logger.debug(f'Received {in_data}')
         updated_obj = self.schema.load(in_data)
@@ -97,4 +241,114 @@ class Manager:
         _endpoint = f'{self.endpoint}/{pk}'
         logger.debug(f'Deleting object at: {_endpoint}')
         result = self.api.delete(_endpoint)
+        self.invalidate_cache()
+        return result
+
+    def bulk_create(self, objs, max_workers=None, method='CREATE'):
+        """
+        Create all objs using up to max_workers concurrent requests. The
+        objects are updated with the data returned from the API, as on
+        save(). Failures don't stop the other objects from being created.
+
+        :returns: BulkResult with (obj, created_obj) for each success.
+        """
+        self.verify_method(method)
+
+        def _create(obj):
+            new_obj = self.create(obj)
+            obj._update_value(obj=new_obj)
+            return new_obj
+
+        return self._bulk(_create, objs, max_workers)
+
+    def bulk_update(self, objs, max_workers=None, method='UPDATE'):
+        """
+        Update all objs using up to max_workers concurrent requests.
+
+        :returns: BulkResult with (obj, updated_obj) for each success.
+        """
+        self.verify_method(method)
+
+        def _update(obj):
+            updated_obj = self.update(obj)
+            obj._update_value(obj=updated_obj)
+            return updated_obj
+
+        return self._bulk(_update, objs, max_workers)
+
+    def bulk_delete(self, pks, max_workers=None, method='DELETE'):
+        """
+        Delete the objects with the primary keys in pks using up to
+        max_workers concurrent requests.
+
+        :returns: BulkResult with (pk, response) for each success.
+        """
+        self.verify_method(method)
+        return self._bulk(self.delete, pks, max_workers)
+
+    def _bulk(self, func, items, max_workers=None):
+        """
+        Call func for every item in a thread pool and collect the results.
+        An exception for one item is recorded in the result instead of
+        being raised.
+        """
+        items = list(items)
+        result = BulkResult()
+
+        with ThreadPoolExecutor(
+                max_workers=max_workers or self.BULK_MAX_WORKERS) as executor:
+            futures = [executor.submit(func, item) for item in items]
+
+            for item, future in zip(items, futures):
+                try:
+                    result.succeeded.append((item, future.result()))
+                except Exception as e:
+                    logger.debug(f'Bulk operation failed on {item}: {e}')
+                    result.failed.append((item, e))
+
+        return result
+
+    async def aget(self, pk, method='GET'):
+        self.verify_method(method)
+        obj = self._get_cached(pk)
+        if obj is not None:
+            return obj
+        _endpoint = f'{self.endpoint}/{pk}'
+        result = await self.async_api.get(_endpoint)
+        data = result.json()
+        logger.debug(f'Received: {data}')
+        obj = self.schema.load(data)
+        self._set_cached(pk, obj)
+        return obj
+
+    async def acreate(self, obj, method='CREATE'):
+        self.verify_method(method)
+        out_data = self.schema.dump(obj)
+        logger.debug(f'Sending: {out_data}')
+        result = await self.async_api.post(self.endpoint, json.dumps(out_data))
+        self.invalidate_cache()
+        in_data = result.json()
+        logger.debug(f'Received {in_data}')
+        new_obj = self.schema.load(in_data)
+        return new_obj
+
+    async def aupdate(self, obj, method='UPDATE'):
+        self.verify_method(method)
+        pk = obj.id
+        _endpoint = f'{self.endpoint}/{pk}'
+        out_data = self.schema.dump(obj)
+        logger.debug(f'Sending {out_data}')
+        result = await self.async_api.put(_endpoint, json.dumps(out_data))
+        self.invalidate_cache()
+        in_data = result.json()
+        logger.debug(f'Received {in_data}')
+        updated_obj = self.schema.load(in_data)
+        return updated_obj
+
+    async def adelete(self, pk, method='DELETE'):
+        self.verify_method(method)
+        _endpoint = f'{self.endpoint}/{pk}'
+        logger.debug(f'Deleting object at: {_endpoint}')
+        result = await self.async_api.delete(_endpoint)
+        self.invalidate_cache()
         return result
@@ -0,0 +1,511 @@
+import datetime
+import decimal
+import json
+import logging
+import uuid
+
+from marshmallow import fields
+
+from visma.api import VismaClientException
+from visma.base import VismaModel
+from visma.query import APIQuerySet, QueryCompiler, FilterParser
+from visma.sync import BaseSQLiteStore, SyncEngine
+from visma.utils import deserialize_values, is_instance_or_subclass
+
+logger = logging.getLogger(__name__)
+
+# Column types of the fields we store as plain values. Everything else, ex.
+# Nested and List, is stored as JSON text.
+COLUMN_TYPES = [
+    (fields.Boolean, 'INTEGER'),
+    (fields.Integer, 'INTEGER'),
+    (fields.Decimal, 'NUMERIC'),
+    (fields.Number, 'REAL'),
+    (fields.DateTime, 'TEXT'),
+    (fields.Date, 'TEXT'),
+    (fields.UUID, 'TEXT'),
+    (fields.String, 'TEXT'),
+]
+
+
+def get_column_type(field):
+    """Return the SQLite type of the column for field or None for JSON."""
+    for field_class, column_type in COLUMN_TYPES:
+        if is_instance_or_subclass(field, field_class):
+            return column_type
+    return None
+
+
+def to_db_value(value):
+    """
+    Convert a python value to the value stored in the database. Datetimes
+    are stored in UTC with a fixed precision so they compare and sort as
+    text.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None)
+        return value.isoformat(timespec='microseconds')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, decimal.Decimal)):
+        return str(value)
+    return value
+
+
+def quote_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_mirrored_models(base=VismaModel):
+    """
+    Return all imported models with an endpoint that can be listed, that is
+    all models we can mirror.
+    """
+    models = list()
+    for model in base.__subclasses__():
+        manager = model.__dict__.get('objects')
+        if manager is not None and 'LIST' in manager.allowed_methods:
+            models.append(model)
+        models.extend(get_mirrored_models(model))
+    return models
+
+
+class SQLFilterParser(FilterParser):
+    operator = None
+
+    def parse(self):
+        return (f'{quote_name(self.key)} {self.operator} ?',
+                [to_db_value(self.value)])
+
+
+class SQLEqualFilterParser(SQLFilterParser):
+    operator = '='
+
+
+class SQLNotEqualFilterParser(SQLFilterParser):
+    # IS NOT also matches NULL, like ne in the API.
+    operator = 'IS NOT'
+
+
+class SQLGreaterThanFilterParser(SQLFilterParser):
+    operator = '>'
+
+
+class SQLGreaterOrEqualThanFilterParser(SQLFilterParser):
+    operator = '>='
+
+
+class SQLLessThanFilterParser(SQLFilterParser):
+    operator = '<'
+
+
+class SQLLessOrEqualThanFilterParser(SQLFilterParser):
+    operator = '<='
+
+
+class SQLInFilterParser(FilterParser):
+
+    def parse(self):
+        placeholders = ', '.join('?' for _ in self.value)
+        return (f'{quote_name(self.key)} IN ({placeholders})',
+                [to_db_value(value) for value in self.value])
+
+
+class SQLNotInFilterParser(FilterParser):
+
+    def parse(self):
+        placeholders = ', '.join('?' for _ in self.value)
+        column = quote_name(self.key)
+        return (f'({column} NOT IN ({placeholders}) OR {column} IS NULL)',
+                [to_db_value(value) for value in self.value])
+
+
+class SQLPatternFilterParser(FilterParser):
+    """
+    Matches a string pattern. Case sensitive matches use GLOB and case
+    insensitive ones LIKE, which only folds the case of ASCII letters.
+    Negated filters also match NULL.
+    """
+    # '{}' is replaced by the escaped value.
+    pattern = None
+    case_insensitive = False
+    negate = False
+
+    def parse(self):
+        column = quote_name(self.key)
+        if self.case_insensitive:
+            escaped = (self.value.replace('\\', '\\\\').replace('%', '\\%')
+                       .replace('_', '\\_'))
+            clause = f"{column} LIKE ? ESCAPE '\\'"
+            pattern = self.pattern.replace('*', '%').format(escaped)
+        else:
+            escaped = ''.join(f'[{char}]' if char in '*?[' else char
+                              for char in self.value)
+            clause = f'{column} GLOB ?'
+            pattern = self.pattern.format(escaped)
+
+        if self.negate:
+            clause = f'(NOT {clause} OR {column} IS NULL)'
+        return clause, [pattern]
+
+
+class SQLContainsFilterParser(SQLPatternFilterParser):
+    pattern = '*{}*'
+
+
+class SQLNotContainsFilterParser(SQLContainsFilterParser):
+    negate = True
+
+
+class SQLIContainsFilterParser(SQLContainsFilterParser):
+    case_insensitive = True
+
+
+class SQLNotIContainsFilterParser(SQLIContainsFilterParser):
+    negate = True
+
+
+class SQLStartsWithFilterParser(SQLPatternFilterParser):
+    pattern = '{}*'
+
+
+class SQLNotStartsWithFilterParser(SQLStartsWithFilterParser):
+    negate = True
+
+
+class SQLIStartsWithFilterParser(SQLStartsWithFilterParser):
+    case_insensitive = True
+
+
+class SQLNotIStartsWithFilterParser(SQLIStartsWithFilterParser):
+    negate = True
+
+
+class SQLEndsWithFilterParser(SQLPatternFilterParser):
+    pattern = '*{}'
+
+
+class SQLNotEndsWithFilterParser(SQLEndsWithFilterParser):
+    negate = True
+
+
+class SQLIEndsWithFilterParser(SQLEndsWithFilterParser):
+    case_insensitive = True
+
+
+class SQLNotIEndsWithFilterParser(SQLIEndsWithFilterParser):
+    negate = True
+
+
+class SQLOrderByFilterParser(FilterParser):
+
+    def parse(self):
+        return f'{quote_name(self.key)} {self.value.upper()}'
+
+
+class SQLQueryCompiler(QueryCompiler):
+    """
+    Compiles a query to the WHERE and ORDER BY clauses of a SQL query on a
+    mirrored model. The values are returned as parameters.
+    """
+    equals_parser_class = SQLEqualFilterParser
+    not_equals_parser_class = SQLNotEqualFilterParser
+    greater_than_parser_class = SQLGreaterThanFilterParser
+    greater_or_equal_parser_class = SQLGreaterOrEqualThanFilterParser
+    less_than_parser_class = SQLLessThanFilterParser
+    less_or_equal_parser_class = SQLLessOrEqualThanFilterParser
+    in_parser_class = SQLInFilterParser
+    not_in_parser_class = SQLNotInFilterParser
+    contains_parser_class = SQLContainsFilterParser
+    not_contains_parser_class = SQLNotContainsFilterParser
+    icontains_parser_class = SQLIContainsFilterParser
+    not_icontains_parser_class = SQLNotIContainsFilterParser
+    startswith_parser_class = SQLStartsWithFilterParser
+    not_startswith_parser_class = SQLNotStartsWithFilterParser
+    istartswith_parser_class = SQLIStartsWithFilterParser
+    not_istartswith_parser_class = SQLNotIStartsWithFilterParser
+    endswith_parser_class = SQLEndsWithFilterParser
+    not_endswith_parser_class = SQLNotEndsWithFilterParser
+    iendswith_parser_class = SQLIEndsWithFilterParser
+    not_iendswith_parser_class = SQLNotIEndsWithFilterParser
+    order_by_parser_class = SQLOrderByFilterParser
+
+    @staticmethod
+    def join_filter_params(param_list, connector='and'):
+        clauses = [clause for clause, _ in param_list]
+        params = [param for _, clause_params in param_list
+                  for param in clause_params]
+        return f' {connector.upper()} '.join(clauses), params
+
+    def group_filter_params(self, param_list, connector):
+        clause, params = self.join_filter_params(param_list, connector)
+        return f'({clause})', params
+
+    def as_sql(self):
+        """
+        :returns: (where, params, order). where and order are SQL clauses
+            without the keywords and empty if not used.
+        """
+        where, params = self.join_filter_params(
+            [_filter.parse() for _filter in self.filters])
+        order = self.get_order_string() if self.order else ''
+        return where, params, order
+
+    @staticmethod
+    def join_order_params(param_list):
+        return ', '.join(param_list)
+
+
+class MirrorModelIterable:
+    """Iterates over the objects of a query on the mirror."""
+
+    def __init__(self, queryset, chunk_size=None):
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        queryset = self.queryset
+        rows = queryset.api.fetch(queryset.model, *self._compile(),
+                                  limit=self._get_limit(),
+                                  offset=queryset.query.low_mark)
+        for row in rows:
+            yield queryset.api.row_to_object(queryset.model, row)
+
+    def _compile(self):
+        query = self.queryset.query
+        compiler = query.query_compiler(query)
+        compiler.compile()
+        return compiler.as_sql()
+
+    def _get_limit(self):
+        query = self.queryset.query
+        if query.high_mark is None:
+            return None
+        return max(query.high_mark - query.low_mark, 0)
+
+    def count(self):
+        where, params, _ = self._compile()
+        return self.queryset.api.count(self.queryset.model, where, params,
+                                       limit=self._get_limit(),
+                                       offset=self.queryset.query.low_mark)
+
+
+class MirrorValuesIterable(MirrorModelIterable):
+    """Yields the rows of values() and values_list() on the mirror."""
+
+    def __iter__(self):
+        queryset = self.queryset
+        field_names = queryset._fields
+        rows = queryset.api.fetch(queryset.model, *self._compile(),
+                                  limit=self._get_limit(),
+                                  offset=queryset.query.low_mark,
+                                  field_names=field_names)
+        for row in rows:
+            yield queryset._format_row(queryset.api.row_to_values(
+                queryset.model, row, field_names))
+
+
+class MirrorQuerySet(APIQuerySet):
+    """
+    A queryset on the objects of a model in a :class:`Mirror`. Supports
+    the same filter(), exclude(), order_by(), values() and slicing as the
+    querysets on the API, but runs them as SQL on the local database.
+    """
+    _values_iterable_class = MirrorValuesIterable
+
+    def __init__(self, model, api, schema=None, **kwargs):
+        super().__init__(model, api, schema, **kwargs)
+        self._iterable_class = MirrorModelIterable
+
+
+class Mirror(BaseSQLiteStore):
+    """
+    Local copy of Visma models in a SQLite database, for reports and other
+    queries that would otherwise paginate through the API every time.
+
+    There is one table per model, named as the model, with one column per
+    schema field. Scalar fields get typed columns, nested and list fields
+    are stored as JSON. The id, foreign id (ex. customer_id) and change
+    timestamp columns are indexed. Datetimes are stored in UTC.
+
+    The mirror is a :class:`~visma.sync.SyncStore`, so models with a change
+    timestamp are updated incrementally by update(). The high-water marks
+    are kept as in :class:`~visma.sync.SQLiteSyncStore`.
+
+    :param str path: Path to the database file.
+    """
+    QUERY_COMPILER_CLASS = SQLQueryCompiler
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._tables = set()
+
+    def objects(self, model):
+        """Return a queryset on the mirrored objects of model."""
+        self.create_table(model)
+        return MirrorQuerySet(model=model, api=self)
+
+    def update(self, models=None, full=False, overlap=None):
+        """
+        Update the mirror from the API. Models with a change timestamp field
+        only fetch changes since the last update, unless full is True. Other
+        models are fetched and replaced in full.
+
+        :param list models: Models to update. Defaults to all models that
+            can be listed.
+        :param datetime.timedelta overlap: Passed on to the SyncEngine.
+        :returns: dict with the number of fetched objects per model.
+        """
+        if models is None:
+            import visma.models  # noqa: F401 Make sure all models are defined
+            models = get_mirrored_models()
+
+        engine = SyncEngine(self) if overlap is None else SyncEngine(
+            self, overlap=overlap)
+        result = dict()
+        for model in models:
+            self.create_table(model)
+            try:
+                engine.get_timestamp_field(model)
+            except VismaClientException:
+                objs = list(model.objects.all().iterator(
+                    chunk_size=engine.chunk_size))
+                self.replace(model, objs)
+                result[model] = len(objs)
+                continue
+
+            if full:
+                self.clear(model)
+            result[model] = engine.sync(model, full=full)
+        return result
+
+    def create_table(self, model):
+        """Create the table and indexes of model if they don't exist."""
+        if model in self._tables:
+            return
+
+        table = quote_name(model.__name__)
+        columns = [(name, get_column_type(field) or 'TEXT')
+                   for name, field in model._schema_items.items()]
+        definitions = [
+            f'{quote_name(name)} {column_type}' +
+            (' PRIMARY KEY' if name == 'id' else '')
+            for name, column_type in columns]
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                f'({", ".join(definitions)})')
+
+            # Add columns for fields added to the model since the table was
+            # created.
+            existing = {row[1] for row in self._connection.execute(
+                f'PRAGMA table_info({table})')}
+            for name, column_type in columns:
+                if name not in existing:
+                    self._connection.execute(
+                        f'ALTER TABLE {table} ADD COLUMN '
+                        f'{quote_name(name)} {column_type}')
+
+            for name, _ in columns:
+                if name.endswith('_id') or name in SyncEngine.TIMESTAMP_FIELDS:
+                    self._connection.execute(
+                        f'CREATE INDEX IF NOT EXISTS '
+                        f'{quote_name(f"{model.__name__}_{name}")} '
+                        f'ON {table} ({quote_name(name)})')
+
+        self._tables.add(model)
+
+    def object_to_row(self, model, obj):
+        row = list()
+        for name, field in model.objects.schema.fields.items():
+            if get_column_type(field) is None:
+                value = field.serialize(name, obj)
+                row.append(json.dumps(value) if value is not None else None)
+            else:
+                row.append(to_db_value(getattr(obj, name)))
+        return row
+
+    def row_to_object(self, model, row):
+        return model(**self.row_to_values(model, row))
+
+    def row_to_values(self, model, row, field_names=None):
+        """
+        Return a dict with the values of a row fetched with field_names,
+        by default all fields.
+        """
+        schema_fields = model.objects.schema.fields
+        values = list()
+        for name, value in zip(field_names or schema_fields, row):
+            if (value is not None and
+                    get_column_type(schema_fields[name]) is None):
+                value = json.loads(value)
+            values.append((name, value))
+        return deserialize_values(schema_fields, values)
+
+    def save(self, model, objs):
+        """Insert or replace objs in the table of model."""
+        self.create_table(model)
+        names = list(model.objects.schema.fields)
+        rows = [self.object_to_row(model, obj) for obj in objs]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f'INSERT OR REPLACE INTO {quote_name(model.__name__)} '
+                f'({", ".join(quote_name(name) for name in names)}) '
+                f'VALUES ({", ".join("?" for _ in names)})', rows)
+
+    def replace(self, model, objs):
+        """Replace all objects of model with objs in one transaction."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                f'DELETE FROM {quote_name(model.__name__)}')
+            self.save(model, objs)
+
+    def clear(self, model):
+        """Remove all objects and the high-water mark of model."""
+        self.create_table(model)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f'DELETE FROM {quote_name(model.__name__)}')
+            self.clear_high_water_mark(model)
+
+    def _select(self, model, columns, where, order, limit, offset):
+        sql = f'SELECT {columns} FROM {quote_name(model.__name__)}'
+        if where:
+            sql += f' WHERE {where}'
+        if order:
+            sql += f' ORDER BY {order}'
+        if limit is not None or offset:
+            sql += f' LIMIT {-1 if limit is None else int(limit)}'
+            sql += f' OFFSET {int(offset)}'
+        return sql
+
+    def fetch(self, model, where='', params=(), order='', limit=None,
+              offset=0, field_names=None):
+        """
+        Return the rows of model matching the where clause, with the
+        columns of field_names or all fields.
+        """
+        self.create_table(model)
+        columns = ', '.join(quote_name(name) for name in
+                            field_names or model.objects.schema.fields)
+        sql = self._select(model, columns, where, order, limit, offset)
+        return self.execute(sql, params)
+
+    def count(self, model, where='', params=(), limit=None, offset=0):
+        self.create_table(model)
+        sql = self._select(model, '1', where, '', limit, offset)
+        return self.execute(f'SELECT COUNT(*) FROM ({sql})', params)[0][0]
+
+    def execute(self, sql, params=()):
+        """
+        Run a SQL query on the mirror and return all rows. Use it for
+        queries the querysets can't express, ex. joins between models.
+        """
+        logger.debug(f'Mirror query: {sql} {params}')
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
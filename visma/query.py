@@ -1,8 +1,19 @@
+import asyncio
+import collections
+import datetime
+import decimal
+import itertools
 import json
+import operator
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 from marshmallow import fields
 
+from visma.cache import TTLCache
+from visma.utils import deserialize_values
+
 """
 THe aim of the query module is to enable adding query parameters to our API Calls
 In the Visma API they use OData parameters to enable extensive filtering.
@@ -60,74 +71,390 @@ class QueryParam:
 
 class APIModelIterable:
     PAGINATION_PAGE_SIZE = 50
+    # The largest page size we ask the API for when fetching a slice.
+    PAGINATION_MAX_PAGE_SIZE = 200
+    # Number of concurrent requests used to fetch the batches of an __in
+    # filter that is too long for one request.
+    IN_BATCH_WORKERS = 4
 
     # TODO: Env variable?
-    # TODO: We neeed a way to limit the response size. We dont want to iterate over all pages all the time.
 
-    def __init__(self, queryset):
+    def __init__(self, queryset, chunk_size=None):
         self.queryset = queryset
+        self.chunk_size = chunk_size or self.PAGINATION_PAGE_SIZE
+        # The pagination metadata of the first page, once it is fetched.
+        self.first_page_meta = None
 
     def __iter__(self):
+        return self._iter_results()
+
+    def _iter_results(self):
         queryset = self.queryset
-        compiler = self.queryset.query.query_compiler(queryset.query)
+        query = queryset.query
+
+        batches = queryset._get_batches()
+        if batches is not None:
+            yield from self._get_batches_concurrently(batches)
+            return
+
+        endpoint, query_params = self._compile()
+
+        if not queryset.envelope:
+            result_data = self._get_page_data(endpoint, query_params, 1,
+                                              self.chunk_size)
+            if query.low_mark == 0 and query.high_mark != 0:
+                obj = self._load_object(result_data)
+                yield obj
+            return
+
+        low, high = query.low_mark, query.high_mark
+        if high is not None and high <= low:
+            return
+
+        page_size = self.get_page_size(low, high)
+        first_page = low // page_size + 1
+        skip = low % page_size
+        remaining = None if high is None else high - low
+
+        # The first page tells us how many pages there are in total.
+        result = self._get_page(endpoint, query_params, first_page, page_size)
+        self.first_page_meta = result.meta
+        pages = range(first_page + 1,
+                      self._get_last_page(result, page_size) + 1)
+
+        if queryset._prefetch_workers:
+            results = self._get_pages_concurrently(
+                endpoint, query_params, pages, page_size,
+                queryset._prefetch_workers)
+        else:
+            results = (self._get_page(endpoint, query_params, page, page_size)
+                       for page in pages)
+
+        for result in itertools.chain([result], results):
+            objs = result.data[skip:]
+            skip = 0
+            if remaining is not None:
+                objs = objs[:remaining]
+                remaining -= len(objs)
+
+            for obj in objs:
+                yield obj
+
+            if remaining == 0:
+                return
+
+    def _compile(self):
+        query = self.queryset.query
+        compiler = query.query_compiler(query)
         compiler.compile()
-        endpoint = queryset.model.Meta.endpoint
+        endpoint = self.queryset.model.Meta.endpoint
+        return endpoint, compiler.get_query_params()
 
-        query_params = compiler.get_query_params()
-        paginate = True
+    def _get_batches_concurrently(self, batches):
+        """
+        Fetch the objects of each batch queryset concurrently and return
+        them merged.
+        """
+        max_workers = (self.queryset._prefetch_workers or
+                       self.IN_BATCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda batch: list(self.__class__(
+                    batch, chunk_size=self.chunk_size)._iter_results()),
+                batches))
+        return self.queryset._merge_batches(results)
+
+    def _get_last_page(self, result, page_size):
+        """
+        Return the last page we need to fetch, given the first page of the
+        result.
+        """
+        last_page = result.meta.total_number_of_pages or 1
+        high = self.queryset.query.high_mark
+        if high is not None:
+            last_page = min(last_page, (high - 1) // page_size + 1)
+        return last_page
 
-        current_page = 1
-        total_number_of_pages = None
-        while paginate:
+    def count(self):
+        """
+        Return the number of objects the query would return. For paginated
+        endpoints this is read from the metadata of a one object page.
+        """
+        queryset = self.queryset
 
-            query_params.update({'$pagesize': self.PAGINATION_PAGE_SIZE,
-                                 '$page': current_page})
+        if not queryset.envelope:
+            return len(list(self))
 
-            api_result = queryset.api.get(endpoint, params=query_params)
+        batches = queryset._get_batches()
+        if batches is not None:
+            max_workers = (queryset._prefetch_workers or
+                           self.IN_BATCH_WORKERS)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                number = sum(executor.map(
+                    lambda batch: self.__class__(batch).count(), batches))
+            return queryset._limit_count(number)
 
-            result_data = api_result.json()
+        endpoint, query_params = self._compile()
 
-            # TODO: Handle pagination. Give control via iterator function as in
-            # django
+        result = self._get_page(endpoint, query_params, 1, 1)
+        return queryset._limit_count(result.meta.total_number_of_results)
 
-            if queryset.envelope:
+    def get_page_size(self, low, high):
+        """
+        Return the page size to use to fetch the objects from low to high
+        with as few requests as possible. If possible we find a page size
+        where all the objects are on one page.
+        """
+        if high is None:
+            return self.chunk_size
 
-                result = queryset.envelope.load(result_data)
-                meta = result.meta
-                total_number_of_pages = meta.total_number_of_pages
+        for page_size in range(high - low, self.PAGINATION_MAX_PAGE_SIZE + 1):
+            if low // page_size == (high - 1) // page_size:
+                return page_size
 
-                objs = result.data
+        return min(high - low, self.PAGINATION_MAX_PAGE_SIZE)
+
+    def _get_page_data(self, endpoint, query_params, page, page_size):
+        params = dict(query_params)
+        params.update({'$pagesize': page_size,
+                       '$page': page})
+        api_result = self.queryset.api.get(endpoint, params=params)
+        return api_result.json()
+
+    def _get_page(self, endpoint, query_params, page, page_size):
+        result_data = self._get_page_data(endpoint, query_params, page,
+                                          page_size)
+        return self._load_page(result_data)
+
+    def _load_page(self, result_data):
+        return self.queryset.envelope.load(result_data)
+
+    def _load_object(self, result_data):
+        return self.queryset.schema.load(data=result_data)
+
+    def _get_pages_concurrently(self, endpoint, query_params, pages,
+                                page_size, max_workers):
+        """
+        Fetch pages using a pool of max_workers threads. At most max_workers
+        pages are requested ahead of the page being consumed and the results
+        are returned in page order.
+        """
+        pages = iter(pages)
+        futures = collections.deque()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for page in itertools.islice(pages, max_workers):
+                    futures.append(executor.submit(
+                        self._get_page, endpoint, query_params, page,
+                        page_size))
+
+                while futures:
+                    result = futures.popleft().result()
+                    for page in itertools.islice(pages, 1):
+                        futures.append(executor.submit(
+                            self._get_page, endpoint, query_params, page,
+                            page_size))
+                    yield result
+            finally:
+                # Don't fetch pages nobody will read if iteration is stopped.
+                for future in futures:
+                    future.cancel()
+
+
+class AsyncAPIModelIterable(APIModelIterable):
+    """
+    Iterates over the objects of a queryset using the async API. The pages
+    after the first one are fetched concurrently, at most
+    PAGINATION_CONCURRENCY at a time, and are returned in page order.
+    """
+    PAGINATION_CONCURRENCY = 4
+
+    def __aiter__(self):
+        return self._aiter_results()
+
+    async def _aiter_results(self):
+        queryset = self.queryset
+        query = queryset.query
+
+        batches = queryset._get_batches()
+        if batches is not None:
+            for obj in await self._get_batches_concurrently(batches):
+                yield obj
+            return
+
+        endpoint, query_params = self._compile()
+
+        if not queryset.envelope:
+            result_data = await self._get_page_data(endpoint, query_params, 1,
+                                                    self.chunk_size)
+            if query.low_mark == 0 and query.high_mark != 0:
+                obj = self._load_object(result_data)
+                yield obj
+            return
+
+        low, high = query.low_mark, query.high_mark
+        if high is not None and high <= low:
+            return
+
+        page_size = self.get_page_size(low, high)
+        first_page = low // page_size + 1
+        skip = low % page_size
+        remaining = None if high is None else high - low
+
+        result = await self._get_page(endpoint, query_params, first_page,
+                                      page_size)
+        self.first_page_meta = result.meta
+        pages = iter(range(first_page + 1,
+                           self._get_last_page(result, page_size) + 1))
+        concurrency = (queryset._prefetch_workers or
+                       self.PAGINATION_CONCURRENCY)
+
+        tasks = collections.deque(
+            asyncio.ensure_future(
+                self._get_page(endpoint, query_params, page, page_size))
+            for page in itertools.islice(pages, concurrency))
+
+        try:
+            while True:
+                objs = result.data[skip:]
+                skip = 0
+                if remaining is not None:
+                    objs = objs[:remaining]
+                    remaining -= len(objs)
 
                 for obj in objs:
                     yield obj
 
-            else:
-                paginate = False
-                obj = queryset.schema.load(data=result_data)
-                yield obj
+                if remaining == 0 or not tasks:
+                    return
+
+                result = await tasks.popleft()
+                for page in itertools.islice(pages, 1):
+                    tasks.append(asyncio.ensure_future(
+                        self._get_page(endpoint, query_params, page,
+                                       page_size)))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _get_batches_concurrently(self, batches):
+        semaphore = asyncio.Semaphore(self.queryset._prefetch_workers or
+                                      self.PAGINATION_CONCURRENCY)
+
+        async def get_batch(batch):
+            async with semaphore:
+                return [obj async for obj in self.__class__(
+                    batch, chunk_size=self.chunk_size)._aiter_results()]
+
+        results = await asyncio.gather(*[get_batch(batch)
+                                         for batch in batches])
+        return self.queryset._merge_batches(results)
+
+    async def _get_page_data(self, endpoint, query_params, page, page_size):
+        params = dict(query_params)
+        params.update({'$pagesize': page_size,
+                       '$page': page})
+        api_result = await self.queryset.async_api.get(endpoint, params=params)
+        return api_result.json()
+
+    async def _get_page(self, endpoint, query_params, page, page_size):
+        result_data = await self._get_page_data(endpoint, query_params, page,
+                                                page_size)
+        return self._load_page(result_data)
+
+
+# The data and metadata of a page of values() rows.
+ValuesPage = collections.namedtuple('ValuesPage', ['data', 'meta'])
+
+
+class ValuesIterableMixin:
+    """
+    Yields the rows of a values() or values_list() queryset. The rows are
+    made from the JSON data without creating model objects, only the
+    fields asked for are deserialized.
+    """
+
+    def __iter__(self):
+        format_row = self.queryset._format_row
+        return (format_row(row) for row in self._iter_results())
+
+    def __aiter__(self):
+        return self._aformat_rows()
+
+    async def _aformat_rows(self):
+        format_row = self.queryset._format_row
+        async for row in self._aiter_results():
+            yield format_row(row)
+
+    def _load_page(self, result_data):
+        envelope = self.queryset.envelope
+        data_field = envelope.fields['data']
+        meta_field = envelope.fields['meta']
+        meta = meta_field.deserialize(result_data[meta_field.data_key])
+        return ValuesPage([self._load_object(item)
+                           for item in result_data[data_field.data_key]],
+                          meta)
 
+    def _load_object(self, result_data):
+        """Return a dict with the values of the fields we need."""
+        schema_fields = self.queryset.schema.fields
+        return deserialize_values(schema_fields, (
+            (field_name, result_data.get(schema_fields[field_name].data_key))
+            for field_name in self.queryset._get_row_field_names()))
 
 
-            if current_page == total_number_of_pages:
-                paginate = False
+class ValuesIterable(ValuesIterableMixin, APIModelIterable):
+    pass
 
-            current_page += 1
 
+class AsyncValuesIterable(ValuesIterableMixin, AsyncAPIModelIterable):
+    pass
 
 
 class APIQuerySet:
+    _values_iterable_class = ValuesIterable
+    _async_values_iterable_class = AsyncValuesIterable
 
-    def __init__(self, model, api, schema, query=None, envelope=None):
+    def __init__(self, model, api, schema, query=None, envelope=None,
+                 async_api=None, cache=None, manager=None):
         self.model = model
-        self.api = api
+        self._api = api
+        self._async_api = async_api
+        # APIs that are not given are resolved from the manager on first use.
+        self.manager = manager
+        self.cache = cache
         self.schema = schema
-        self.query = query or APIQuery(model=model,
-                                       query_compiler=api.QUERY_COMPILER_CLASS)
+        if query is None:
+            # Async only setups might not have a sync API to get the
+            # compiler from
+            query_compiler = getattr(
+                api, 'QUERY_COMPILER_CLASS', None) or getattr(
+                async_api, 'QUERY_COMPILER_CLASS', None)
+            query = APIQuery(model=model, query_compiler=query_compiler)
+        self.query = query
         self.envelope = envelope
 
         self._iterable_class = APIModelIterable  # TODO: Implemnt pagination over this.
+        self._async_iterable_class = AsyncAPIModelIterable
         # TODO: How to handle different pagination?
         self._result_cache = None
+        self._prefetch_workers = None
+        # The fields and row format of values() and values_list().
+        self._fields = None
+        self._values_format = None
+
+    @property
+    def api(self):
+        if self._api is None and self.manager is not None:
+            self._api = self.manager.api
+        return self._api
+
+    @property
+    def async_api(self):
+        if self._async_api is None and self.manager is not None:
+            self._async_api = self.manager.async_api
+        return self._async_api
 
     def __repr__(self):
         data = list(self._result_cache[:REPR_OUTPUT_SIZE + 1])
@@ -139,12 +466,24 @@ class APIQuerySet:
         self._fetch_all()
         return iter(self._result_cache)
 
+    async def __aiter__(self):
+        if self._result_cache is None:
+            self._result_cache = self._get_cached_result()
+        if self._result_cache is None:
+            self._result_cache = [
+                obj async for obj in self._async_iterable_class(self)]
+            self._set_cached_result(self._result_cache)
+        for obj in self._result_cache:
+            yield obj
+
     def __len__(self):
-        self._fetch_all()
+        if self._result_cache is None:
+            return self.count()
         return len(self._result_cache)
 
     def __bool__(self):
-        self._fetch_all()
+        if self._result_cache is None:
+            return self.exists()
         return bool(self._result_cache)
 
     def __getitem__(self, k):
@@ -159,46 +498,165 @@ class APIQuerySet:
         if self._result_cache is not None:
             return self._result_cache[k]
 
+        # Only fetch the pages needed for the requested objects.
         if isinstance(k, slice):
-            return list(self)[k.start:k.stop]
+            qs = self._chain()
+            start = int(k.start) if k.start is not None else None
+            stop = int(k.stop) if k.stop is not None else None
+            qs.query.set_limits(start, stop)
+            return list(qs)[::k.step] if k.step else qs
 
-        self._fetch_all()
+        qs = self._chain()
+        qs.query.set_limits(k, k + 1)
+        qs._fetch_all()
 
-        return self._result_cache[k]
+        return qs._result_cache[0]
 
-    def filter(self, **kwargs):
+    def filter(self, *args, **kwargs):
         """
         Return a new QuerySet instance with the args ANDed to the existing
-        set.
+        set. args are Q objects.
         """
-        return self._filter_or_exclude(False, **kwargs)
+        return self._filter_or_exclude(False, *args, **kwargs)
 
-    def exclude(self, **kwargs):
+    def exclude(self, *args, **kwargs):
         """
         Return a new QuerySet instance with NOT (args) ANDed to the existing
         set.
         """
-        return self._filter_or_exclude(True, **kwargs)
+        return self._filter_or_exclude(True, *args, **kwargs)
 
-    def _filter_or_exclude(self, negate, **kwargs):
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        if self.query.is_sliced:
+            raise TypeError('Cannot filter a query once a slice has been '
+                            'taken.')
         clone = self._chain()
 
-        clone.query.add_filter(negate, **kwargs)
+        clone.query.add_filter(negate, *args, **kwargs)
+        if clone.query.select:
+            clone.query.set_select(clone._get_row_field_names())
 
         return clone
 
-    def order_by(self, field_name):
-        """Return a new QuerySet instance with the ordering changed."""
+    def order_by(self, *field_names):
+        """
+        Return a new QuerySet instance ordered by field_names, replacing
+        any previous ordering. Prefix a field name with - to order it
+        descending, ex. order_by('-changed_utc', 'name').
+        """
         obj = self._chain()
-        obj.query.add_ordering(field_name)
+        obj.query.clear_ordering()
+        obj.query.add_ordering(*field_names)
+        if obj.query.select:
+            obj.query.set_select(obj._get_row_field_names())
         return obj
 
+    def count(self):
+        """
+        Return the number of objects in the QuerySet. If the QuerySet has not
+        been evaluated this is one minimal request to the API instead of
+        fetching all the objects.
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return self._iterable_class(self).count()
+
+    def exists(self):
+        """Return True if the QuerySet contains any objects."""
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self.count() > 0
+
+    def iterator(self, chunk_size=None):
+        """
+        An iterator over the results from applying this QuerySet to the API.
+        Objects are streamed page by page, chunk_size objects per request, and
+        are not stored in the result cache, so memory use does not grow with
+        the size of the result.
+        """
+        if self._result_cache is not None:
+            return iter(self._result_cache)
+        return iter(self._iterable_class(self, chunk_size=chunk_size))
+
+    def aiterator(self, chunk_size=None):
+        """
+        An async iterator over the results from applying this QuerySet to
+        the async API. Like iterator() the objects are not stored in the
+        result cache.
+        """
+        return self._async_iterable_class(self,
+                                          chunk_size=chunk_size).__aiter__()
+
+    def prefetch(self, max_workers=4):
+        """
+        Return a new QuerySet instance that fetches the remaining pages
+        concurrently using max_workers threads once the first page has told
+        us how many pages there are. Objects are still returned in page order.
+        """
+        obj = self._chain()
+        obj._prefetch_workers = max_workers
+        return obj
+
+    def values(self, *fields):
+        """
+        Return a new QuerySet instance that yields a dict for each object
+        with the values of fields, or all fields if none are given, instead
+        of model objects.
+        """
+        return self._values(fields, 'dict')
+
+    def values_list(self, *fields, flat=False):
+        """
+        Like values() but yields tuples. If flat is True and there is one
+        field the values are yielded as they are.
+        """
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid when values_list is called "
+                            "with one field.")
+        return self._values(fields, 'flat' if flat else 'tuple')
+
+    def _values(self, fields, values_format):
+        fields = fields or tuple(self.model._schema_items)
+        for field_name in fields:
+            if field_name not in self.model._schema_items:
+                raise ValueError(
+                    f'Model {self.model.__name__} does not have the field '
+                    f'{field_name}')
+
+        clone = self._chain()
+        clone._fields = fields
+        clone._values_format = values_format
+        clone._iterable_class = self._values_iterable_class
+        clone._async_iterable_class = self._async_values_iterable_class
+        if getattr(self.model.objects, 'supports_select', False):
+            clone.query.set_select(clone._get_row_field_names())
+        return clone
+
+    def _get_row_field_names(self):
+        """
+        The fields of the rows before they are formatted. The ordering
+        fields and the field of a batched __in filter are included so
+        fetched batches can be sorted.
+        """
+        order_fields = [field_name.lstrip('-')
+                        for field_name in self.query.order_by]
+        in_filter = self._get_batched_in_filter()
+        if in_filter is not None:
+            order_fields.append(in_filter[0][:-len('__in')])
+        return list(dict.fromkeys([*self._fields, *order_fields]))
+
+    def _format_row(self, row):
+        if self._values_format == 'dict':
+            return {field_name: row[field_name] for field_name in self._fields}
+        if self._values_format == 'flat':
+            return row[self._fields[0]]
+        return tuple(row[field_name] for field_name in self._fields)
+
     def first(self):
         """Return the first object of a query or None if no match is found."""
-        if len(self) == 0:
-            return None
-        else:
-            return self[0]
+        for obj in self[:1]:
+            return obj
+        return None
 
     def _chain(self, **kwargs):
         """
@@ -215,13 +673,180 @@ class APIQuerySet:
         to deepcopy().
         """
         c = self.__class__(model=self.model, query=self.query.chain(),
-                           api=self.api, schema=self.schema,
-                           envelope=self.envelope)
+                           api=self._api, schema=self.schema,
+                           envelope=self.envelope, async_api=self._async_api,
+                           cache=self.cache, manager=self.manager)
+        c._prefetch_workers = self._prefetch_workers
+        c._fields = self._fields
+        c._values_format = self._values_format
+        c._iterable_class = self._iterable_class
+        c._async_iterable_class = self._async_iterable_class
         return c
 
+    def _limit_count(self, number):
+        """Apply the limits of the query to the number of matching objects."""
+        number = max(0, number - self.query.low_mark)
+        if self.query.high_mark is not None:
+            number = min(number, self.query.high_mark - self.query.low_mark)
+        return number
+
+    def _get_filter_length(self):
+        compiler = self.query.query_compiler(self.query)
+        compiler.compile()
+        return compiler.get_filter_length()
+
+    def _get_batches(self):
+        """
+        Return querysets that together fetch the objects of the query when
+        an __in filter makes the filter longer than the compiler allows, or
+        None if the query fits in one request. The longest __in list is
+        split in halves until each batch is short enough.
+        """
+        max_length = self.query.query_compiler.max_filter_length
+        in_filter = self._get_batched_in_filter()
+        if (max_length is None or in_filter is None or
+                self._get_filter_length() <= max_length):
+            return None
+
+        attr, values = in_filter
+        pending = [list(dict.fromkeys(values))]
+        batches = list()
+        while pending:
+            batch_values = pending.pop()
+            batch = self._chain()
+            batch.query.filter_by[attr] = batch_values
+            batch.query.low_mark, batch.query.high_mark = 0, None
+
+            if (len(batch_values) > 1 and
+                    batch._get_filter_length() > max_length):
+                half = len(batch_values) // 2
+                pending.extend([batch_values[half:], batch_values[:half]])
+            else:
+                batches.append(batch)
+        return batches
+
+    def _get_batched_in_filter(self):
+        """
+        Return (attr, values) of the __in filter that is split into batches
+        when the filter is too long, the one with the most values, or None.
+        """
+        in_filters = [(attr, values)
+                      for attr, values in self.query.filter_by.items()
+                      if attr.endswith('__in')]
+        return max(in_filters, key=lambda item: len(item[1]), default=None)
+
+    def _get_value_getter(self, field_name):
+        if self._fields is None:
+            return operator.attrgetter(field_name)
+        return operator.itemgetter(field_name)
+
+    def _merge_batches(self, results):
+        """
+        Merge the objects fetched by the batches of _get_batches(), ordered
+        and limited as the query. Without an ordering the objects are in
+        the order of their value in the batched __in list.
+        """
+        objs = [obj for result in results for obj in result]
+        if not self.query.order_by:
+            attr, values = self._get_batched_in_filter()
+            # Compared as strings, so ids match whether given as str or UUID.
+            positions = dict()
+            for position, value in enumerate(values):
+                positions.setdefault(str(value), position)
+            get_value = self._get_value_getter(attr[:-len('__in')])
+            objs.sort(key=lambda obj: positions.get(str(get_value(obj)),
+                                                    len(positions)))
+
+        # Sort on the last field first, the sort is stable so the earlier
+        # fields decide.
+        for field_name in reversed(self.query.order_by):
+            descending = field_name.startswith('-')
+            get_value = self._get_value_getter(field_name.lstrip('-'))
+            objs.sort(key=lambda obj: (get_value(obj) is None, get_value(obj)),
+                      reverse=descending)
+        return objs[self.query.low_mark:self.query.high_mark]
+
     def _fetch_all(self):
+        if self._result_cache is None:
+            self._result_cache = self._get_cached_result()
         if self._result_cache is None:
             self._result_cache = list(self._iterable_class(self))
+            self._set_cached_result(self._result_cache)
+
+    def _get_cache_key(self):
+        endpoint, query_params = self._iterable_class(self)._compile()
+        return ('list', endpoint, tuple(sorted(query_params.items())),
+                self.query.low_mark, self.query.high_mark, self._fields,
+                self._values_format)
+
+    def _get_cached_result(self):
+        if self.cache is None:
+            return None
+        result = self.cache.get(self._get_cache_key())
+        return list(result) if result is not None else None
+
+    def _set_cached_result(self, result):
+        """
+        Cache the result of the query. The objects are also cached one by one
+        so a later get() on one of them doesn't need a request.
+        """
+        if self.cache is None:
+            return
+        for obj in result:
+            pk = getattr(obj, 'id', None)
+            if pk is not None:
+                self.cache.set(('get', str(pk)), obj)
+        self.cache.set(self._get_cache_key(), list(result))
+
+
+class Q:
+    """
+    Encapsulate filters as objects that can be combined with & (and),
+    | (or) and negated with ~. Keyword arguments are the same as for
+    filter().
+
+    Customer.objects.filter(Q(invoice_city='Helsingborg') |
+                            Q(invoice_city='Lund'))
+    """
+    AND = 'and'
+    OR = 'or'
+
+    def __init__(self, *args, _connector=None, _negated=False, **kwargs):
+        self.children = [*args, *sorted(kwargs.items())]
+        self.connector = _connector or self.AND
+        self.negated = _negated
+
+    def _combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError(other)
+        if not other:
+            return self._copy()
+        if not self:
+            return other._copy()
+        return self.__class__(self, other, _connector=connector)
+
+    def _copy(self):
+        return self.__class__(*self.children, _connector=self.connector,
+                              _negated=self.negated)
+
+    def __or__(self, other):
+        return self._combine(other, self.OR)
+
+    def __and__(self, other):
+        return self._combine(other, self.AND)
+
+    def __invert__(self):
+        obj = self._copy()
+        obj.negated = not self.negated
+        return obj
+
+    def __bool__(self):
+        return bool(self.children)
+
+    def __repr__(self):
+        template = '(NOT (%s: %s))' if self.negated else '(%s: %s)'
+        return template % (self.connector.upper(),
+                           ', '.join(str(child) for child in self.children))
 
 
 class APIQuery:
@@ -231,19 +856,60 @@ class APIQuery:
         self.query_compiler = query_compiler or QueryCompiler
         self.filter_by = {}
         self.exclude_by = {}
+        self.where = []
         self.order_by = []
+        self.select = []
+        self.low_mark = 0
+        self.high_mark = None
 
-    def add_filter(self, negate, **kwargs):
+    def add_filter(self, negate, *args, **kwargs):
         # TODO: Validate that it is possible to filter.
+        for q in args:
+            if not isinstance(q, Q):
+                raise TypeError(f'{q!r} is not a Q object')
+            self.where.append(~q if negate else q)
+
         if negate:
             self.exclude_by.update(**kwargs)
         else:
             self.filter_by.update(**kwargs)
 
-    def add_ordering(self, field_name):
+    def add_ordering(self, *field_names):
         # TODO: Validate it is possible to order by.
-        """Will keep all the fields"""
-        self.order_by.append(field_name)
+        """Add field_names to the ordering. A - prefix means descending."""
+        self.order_by.extend(field_names)
+
+    def clear_ordering(self):
+        self.order_by = []
+
+    def set_select(self, field_names):
+        """Only ask the API for field_names."""
+        self.select = list(field_names)
+
+    def set_limits(self, low=None, high=None):
+        """
+        Adjust the limits on the rows retrieved. Use low/high to set these,
+        as it makes it more Pythonic to read and write. When the query is
+        compiled these are translated to the pages needed to fetch the rows.
+
+        Any limits passed in here are applied relative to the existing
+        constraints. So low is added to the current low value and both will
+        be clamped to any existing high value.
+        """
+        if high is not None:
+            if self.high_mark is not None:
+                self.high_mark = min(self.high_mark, self.low_mark + high)
+            else:
+                self.high_mark = self.low_mark + high
+        if low is not None:
+            if self.high_mark is not None:
+                self.low_mark = min(self.high_mark, self.low_mark + low)
+            else:
+                self.low_mark = self.low_mark + low
+
+    @property
+    def is_sliced(self):
+        return self.low_mark != 0 or self.high_mark is not None
 
     def chain(self, klass=None):
         """
@@ -262,9 +928,13 @@ class APIQuery:
         to deepcopy().
         """
         c = self.__class__(model=self.model, query_compiler=self.query_compiler)
-        c.filter_by = self.filter_by
-        c.exclude_by = self.exclude_by
-        c.order_by = self.order_by
+        c.filter_by = self.filter_by.copy()
+        c.exclude_by = self.exclude_by.copy()
+        c.where = self.where.copy()
+        c.order_by = self.order_by.copy()
+        c.select = self.select.copy()
+        c.low_mark = self.low_mark
+        c.high_mark = self.high_mark
         return c
 
 
@@ -296,38 +966,128 @@ class Filter:
     def parse(self):
         return self.parser.parse()
 
+    def get_template(self):
+        return FilterTemplate(self.parser.__class__, self.key,
+                              self.value_field)
+
     # TODO: Is parse the right word?
 
 
+# Values that are compared as dates, times or exact numbers. The type check is
+# exact so datetime has to be listed next to date.
+TEMPORAL_AND_DECIMAL_TYPES = [datetime.date, datetime.datetime,
+                              decimal.Decimal]
+
+
 class Equals(Filter):
-    allowed_input_value_types = [int, float, str, uuid.UUID]
+    allowed_input_value_types = [int, float, str, uuid.UUID,
+                                 *TEMPORAL_AND_DECIMAL_TYPES]
 
 
 class NotEquals(Filter):
-    allowed_input_value_types = [int, float, str, uuid.UUID]
+    allowed_input_value_types = [int, float, str, uuid.UUID,
+                                 *TEMPORAL_AND_DECIMAL_TYPES]
 
 
 class GreaterThan(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, *TEMPORAL_AND_DECIMAL_TYPES]
 
 
 class GreaterThanOrEqual(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, *TEMPORAL_AND_DECIMAL_TYPES]
 
 
 class LessThan(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, *TEMPORAL_AND_DECIMAL_TYPES]
 
 
 class LessThanOrEquals(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, *TEMPORAL_AND_DECIMAL_TYPES]
+
+
+class In(Filter):
+    allowed_input_value_types = [list, tuple, set]
+    allowed_item_types = Equals.allowed_input_value_types
+
+    def validate(self):
+        super().validate()
+        for item in self.value:
+            if type(item) not in self.allowed_item_types:
+                raise ValueError(
+                    f'Value {item} of type {item.__class__} '
+                    f'and filter operation '
+                    f'{self.__class__} not interoperable')
+
+
+class NotIn(In):
+    pass
+
+
+class Contains(Filter):
+    allowed_input_value_types = [str]
+
+
+class StartsWith(Filter):
+    allowed_input_value_types = [str]
+
+
+class EndsWith(Filter):
+    allowed_input_value_types = [str]
 
 
 class OrderBy(Filter):
-    allowed_input_value_types = [str, uuid.UUID]
+    """The value is the direction, ASCENDING or DESCENDING."""
+    ASCENDING = 'asc'
+    DESCENDING = 'desc'
+    allowed_input_value_types = [str]
+
 
+class FilterGroup:
+    """Filters and groups joined by a connector, compiled from a Q object."""
+
+    def __init__(self, children, connector, compiler):
+        self.children = children
+        self.connector = connector
+        self.compiler = compiler
+
+    def parse(self):
+        params = [child.parse() for child in self.children]
+        if len(params) == 1:
+            return params[0]
+        return self.compiler.group_filter_params(params, self.connector)
+
+    def get_template(self):
+        return FilterGroupTemplate([child.get_template()
+                                    for child in self.children],
+                                   self.connector)
+
+
+class FilterTemplate:
+    """
+    A validated filter without its value. Binding a value returns the
+    parser for it, skipping the lookups and validation of Filter.
+    """
+
+    def __init__(self, parser_class, key, field):
+        self.parser_class = parser_class
+        self.key = key
+        self.field = field
+
+    def bind(self, values, compiler):
+        return self.parser_class(self.key, next(values), self.field)
+
+
+class FilterGroupTemplate:
+
+    def __init__(self, children, connector):
+        self.children = children
+        self.connector = connector
+
+    def bind(self, values, compiler):
+        return FilterGroup([child.bind(values, compiler)
+                            for child in self.children],
+                           self.connector, compiler)
 
-# TODO: Add string comparison funtions and date functions.
 
 class FilterParser:
     def __init__(self, key, value, field):
@@ -359,16 +1119,41 @@ class QueryCompiler:
     greater_or_equal_parser_class = NoneFilterParser
     less_than_parser_class = NoneFilterParser
     less_or_equal_parser_class = NoneFilterParser
+    in_parser_class = NoneFilterParser
+    not_in_parser_class = NoneFilterParser
+    contains_parser_class = NoneFilterParser
+    not_contains_parser_class = NoneFilterParser
+    icontains_parser_class = NoneFilterParser
+    not_icontains_parser_class = NoneFilterParser
+    startswith_parser_class = NoneFilterParser
+    not_startswith_parser_class = NoneFilterParser
+    istartswith_parser_class = NoneFilterParser
+    not_istartswith_parser_class = NoneFilterParser
+    endswith_parser_class = NoneFilterParser
+    not_endswith_parser_class = NoneFilterParser
+    iendswith_parser_class = NoneFilterParser
+    not_iendswith_parser_class = NoneFilterParser
 
     order_by_parser_class = NoneFilterParser
 
     filter_param = '$filter'
-    order_param = '$order_by'
+    select_param = '$select'
+    # Longest url encoded filter parameter to send in one request. An __in
+    # filter that is longer is split into several requests. None means no
+    # limit.
+    max_filter_length = None
+    order_param = '$orderby'
+
+    # Compiled filters and ordering by query shape, that is the model, the
+    # filter names, the types of the values and the ordering. A query with
+    # a known shape only binds its values to the cached filters. Set to None
+    # to compile every query from scratch.
+    template_cache = TTLCache(maxsize=1024, ttl=None)
 
     def __init__(self, query):
         self.query = query
         self.filters = list()
-        self.order = None
+        self.order = list()
 
     @property
     def filter_map(self):
@@ -378,8 +1163,14 @@ class QueryCompiler:
             'gt': (GreaterThan, self.greater_than_parser_class),
             'gte': (GreaterThanOrEqual, self.greater_or_equal_parser_class),
             'lt': (LessThan, self.less_than_parser_class),
-            'lte': (LessThanOrEquals, self.less_or_equal_parser_class)
-
+            'lte': (LessThanOrEquals, self.less_or_equal_parser_class),
+            'in': (In, self.in_parser_class),
+            'contains': (Contains, self.contains_parser_class),
+            'icontains': (Contains, self.icontains_parser_class),
+            'startswith': (StartsWith, self.startswith_parser_class),
+            'istartswith': (StartsWith, self.istartswith_parser_class),
+            'endswith': (EndsWith, self.endswith_parser_class),
+            'iendswith': (EndsWith, self.iendswith_parser_class),
         }
 
     @property
@@ -387,34 +1178,114 @@ class QueryCompiler:
         return {
             'exact': (NotEquals, self.not_equals_parser_class),
             'not': (Equals, self.equals_parser_class),
-            'gt': (LessThan, self.less_than_parser_class),
-            'gte': (LessThanOrEquals, self.less_or_equal_parser_class),
-            'lt': (GreaterThan, self.greater_than_parser_class),
-            'lte': (GreaterThanOrEqual, self.greater_or_equal_parser_class),
+            'gt': (LessThanOrEquals, self.less_or_equal_parser_class),
+            'gte': (LessThan, self.less_than_parser_class),
+            'lt': (GreaterThanOrEqual, self.greater_or_equal_parser_class),
+            'lte': (GreaterThan, self.greater_than_parser_class),
+            'in': (NotIn, self.not_in_parser_class),
+            'contains': (Contains, self.not_contains_parser_class),
+            'icontains': (Contains, self.not_icontains_parser_class),
+            'startswith': (StartsWith, self.not_startswith_parser_class),
+            'istartswith': (StartsWith, self.not_istartswith_parser_class),
+            'endswith': (EndsWith, self.not_endswith_parser_class),
+            'iendswith': (EndsWith, self.not_iendswith_parser_class),
         }
 
     def compile(self):
+        if self.template_cache is None:
+            self.compile_query()
+            return
+
+        key, values = self.get_shape()
+        template = self.template_cache.get(key)
+        if template is None:
+            self.compile_query()
+            self.template_cache.set(
+                key, ([_filter.get_template() for _filter in self.filters],
+                      list(self.order)))
+            return
+
+        filter_templates, order = template
+        self.order = list(order)
+        values = iter(values)
+        self.filters = [filter_template.bind(values, self)
+                        for filter_template in filter_templates]
+
+    def get_shape(self):
+        """
+        Return the shape of the query, used as key in the template cache,
+        and the filter values in the order compile_query() adds the filters.
+        """
+        query = self.query
+        values = list()
+        shape = [self.__class__, query.model, tuple(query.order_by)]
+        for param_dict in (query.filter_by, query.exclude_by):
+            for filtering_attr, value in param_dict.items():
+                shape.append((filtering_attr, self._get_value_shape(value)))
+                values.append(value)
+            # Separates the filters from the excludes.
+            shape.append(None)
+        for q in query.where:
+            shape.append(self._get_q_shape(q, values))
+        return tuple(shape), values
+
+    @staticmethod
+    def _get_value_shape(value):
+        value_type = type(value)
+        if value_type in (list, tuple, set):
+            return value_type, frozenset(type(item) for item in value)
+        return value_type
+
+    def _get_q_shape(self, q, values):
+        shape = [q.connector, q.negated]
+        for child in q.children:
+            if isinstance(child, Q):
+                shape.append(self._get_q_shape(child, values))
+            else:
+                filtering_attr, value = child
+                shape.append((filtering_attr, self._get_value_shape(value)))
+                values.append(value)
+        return tuple(shape)
+
+    def compile_query(self):
         if self.query.filter_by:
             self.parse_kwarg(self.query.filter_by, self.filter_map)
         if self.query.exclude_by:
             self.parse_kwarg(self.query.exclude_by, self.exclude_map)
+        for q in self.query.where:
+            group = self.parse_q(q)
+            if group is not None:
+                self.filters.append(group)
         if self.query.order_by:
             self.parse_order(self.query.order_by)
 
     def parse_order(self, order_list):
-        # get the last called order by
-
-        order_val = order_list[-1]
-        self.order = OrderBy(order_val, '', self.query.model,
-                             self.order_by_parser_class)
+        for order_val in order_list:
+            if order_val.startswith('-'):
+                key, direction = order_val[1:], OrderBy.DESCENDING
+            else:
+                key, direction = order_val, OrderBy.ASCENDING
+            self.order.append(OrderBy(key, direction, self.query.model,
+                                      self.order_by_parser_class))
 
     def get_filter_string(self):
         filter_params = [_filter.parse() for _filter in self.filters]
         filter_string = self.join_filter_params(filter_params)
         return filter_string
 
+    def get_select_string(self):
+        schema_items = self.query.model._schema_items
+        return ','.join(schema_items[field_name].data_key
+                        for field_name in self.query.select)
+
+    def get_filter_length(self):
+        """Length of the filter parameter when url encoded."""
+        if not self.filters:
+            return 0
+        return len(urlencode({self.filter_param: self.get_filter_string()}))
+
     def get_order_string(self):
-        return self.order.parse()
+        return self.join_order_params([order.parse() for order in self.order])
 
     def get_query_params(self):
 
@@ -423,44 +1294,85 @@ class QueryCompiler:
         if self.filters:
             query_params.update({self.filter_param: self.get_filter_string()})
 
-        if self.query.order_by:
-            # get the last order by reference
+        if self.order:
             query_params.update({self.order_param: self.get_order_string()})
 
+        if self.query.select:
+            query_params.update({self.select_param: self.get_select_string()})
+
         return query_params
 
     @staticmethod
-    def join_filter_params(param_list):
+    def join_filter_params(param_list, connector='and'):
         # TODO: This is VISMA API dependant. Should be defined in the VIsmaAPICompiler.
-        filter_string = ' and '.join(param_list)
+        filter_string = f' {connector} '.join(param_list)
         return filter_string
 
-    def parse_kwarg(self, param_dict, mapping):
+    @staticmethod
+    def join_order_params(param_list):
+        return ','.join(param_list)
+
+    def group_filter_params(self, param_list, connector):
+        """Join param_list and put it in parentheses."""
+        return f'({self.join_filter_params(param_list, connector)})'
+
+    def parse_q(self, q, negate=False):
+        """
+        Return a FilterGroup for the Q object q, or None if it is empty.
+
+        Negations are pushed down to the filters using De Morgan's laws, so
+        NOT (a AND b) is compiled as (NOT a) OR (NOT b) and each negated
+        filter uses the exclude map, ex. NOT a > 1 becomes a <= 1.
+        """
+        negate = negate != q.negated
+        connector = q.connector
+        if negate:
+            connector = Q.OR if connector == Q.AND else Q.AND
+        mapping = self.exclude_map if negate else self.filter_map
+
+        children = list()
+        for child in q.children:
+            if isinstance(child, Q):
+                group = self.parse_q(child, negate)
+                if group is not None:
+                    children.append(group)
+            else:
+                filtering_attr, value = child
+                children.append(self.make_filter(filtering_attr, value,
+                                                 mapping))
+
+        if not children:
+            return None
+        return FilterGroup(children, connector, self)
+
+    def make_filter(self, filtering_attr, value, mapping):
         """
         Will parse a key, ex name_equal=13 to attr name and function equal
         value 13.
         No function defaults to equals.
         Or size__gte, attr size, function greaterthanorequal
-        :returns: Param
+        :returns: Filter
         """
+        settings = filtering_attr.split('__')
+        if len(settings) == 1:
+            #  No __ in expression. Assume exact
+            key, lookup = settings[0], 'exact'
+        elif len(settings) == 2:
+            key, lookup = settings
+        else:
+            raise ValueError(f'Can not filter on {filtering_attr}')
+
+        try:
+            filter_class, parser = mapping[lookup]
+        except KeyError:
+            raise ValueError(f'Unknown filter function {lookup} in '
+                             f'{filtering_attr}')
+
+        return filter_class(key=key, value=value, model=self.query.model,
+                            parser=parser)
+
+    def parse_kwarg(self, param_dict, mapping):
+        """Add a filter for each item in param_dict."""
         for filtering_attr, value in param_dict.items():
-            filter_class = None
-            key = None
-            parser = None
-            settings = filtering_attr.split('__')
-
-            if len(settings) == 1:
-                #  No __ in expression. Assume exact
-                key = settings[0]
-                filter_class = mapping.get('exact')[0]
-                parser = mapping.get('exact')[1]
-            elif len(settings) == 2:
-                key, klass = settings
-                filter_class = mapping.get(klass)[0]
-                parser = mapping.get(klass)[1]
-
-            if filter_class:
-                self.filters.append(filter_class(key=key,
-                                                 value=value,
-                                                 model=self.query.model,
-                                                 parser=parser))
+            self.filters.append(self.make_filter(filtering_attr, value,
+                                                 mapping))
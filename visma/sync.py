@@ -0,0 +1,243 @@
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+
+import iso8601
+
+from visma.api import VismaClientException
+from visma.utils import deserialize_values
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_object(obj):
+    """
+    Return the values of all schema fields on obj as JSON compatible data,
+    keyed by field name. Unlike dumping with the schema, load only fields
+    like ids and timestamps are included.
+    """
+    schema = obj.objects.schema
+    return {field_name: field.serialize(field_name, obj)
+            for field_name, field in schema.fields.items()}
+
+
+def deserialize_object(model, data):
+    """Create a model object from data made by serialize_object()."""
+    schema_fields = model.objects.schema.fields
+    return model(**deserialize_values(
+        schema_fields, ((field_name, data.get(field_name))
+                        for field_name in schema_fields)))
+
+
+def _as_utc(value):
+    """Naive timestamps from the API are in UTC."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+class SyncStore:
+    """
+    Base class for local storage of synced objects and the high-water mark
+    of each synced model.
+    """
+
+    def get_high_water_mark(self, model):
+        raise NotImplementedError(f'The get_high_water_mark function on '
+                                  f'{self.__class__} needs to be overridden')
+
+    def set_high_water_mark(self, model, value):
+        raise NotImplementedError(f'The set_high_water_mark function on '
+                                  f'{self.__class__} needs to be overridden')
+
+    def save(self, model, objs):
+        """Insert or replace objs in the store."""
+        raise NotImplementedError(f'The save function on {self.__class__} '
+                                  f'needs to be overridden')
+
+
+class BaseSQLiteStore(SyncStore):
+    """
+    Base class for stores in a SQLite database. Keeps the high-water marks
+    in the sync_state table, subclasses decide how objects are stored.
+
+    :param str path: Path to the database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sync_state ('
+                'model TEXT PRIMARY KEY, high_water_mark TEXT)')
+
+    def get_high_water_mark(self, model):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT high_water_mark FROM sync_state WHERE model = ?',
+                (model.__name__,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return iso8601.parse_date(row[0])
+
+    def set_high_water_mark(self, model, value):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state (model, high_water_mark) '
+                'VALUES (?, ?)', (model.__name__, value.isoformat()))
+
+    def clear_high_water_mark(self, model):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM sync_state WHERE model = ?', (model.__name__,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class SQLiteSyncStore(BaseSQLiteStore):
+    """
+    Stores synced objects as JSON in a SQLite database.
+
+    :param str path: Path to the database file.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'model TEXT, pk TEXT, data TEXT, PRIMARY KEY (model, pk))')
+
+    def save(self, model, objs):
+        rows = [(model.__name__, str(obj.id), json.dumps(serialize_object(obj)))
+                for obj in objs]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO objects (model, pk, data) '
+                'VALUES (?, ?, ?)', rows)
+
+    def get_objects(self, model):
+        """Return all stored objects of model."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT data FROM objects WHERE model = ? ORDER BY pk',
+                (model.__name__,)).fetchall()
+        return [deserialize_object(model, json.loads(data)) for data, in rows]
+
+
+class SyncEngine:
+    """
+    Fetches the objects of a model that have changed since the last sync and
+    saves them in a store.
+
+    The objects are fetched in chunks ordered by their change timestamp.
+    Each chunk is a new query for objects changed since the last timestamp
+    seen, skipping the objects already saved with that timestamp, instead
+    of the next page of one query. Objects changing while the sync runs
+    therefore can't shift unseen objects onto pages that are already
+    fetched.
+
+    The newest change timestamp seen is saved as a high-water mark per
+    model, but never later than the server time of the first request.
+    Objects changed while the sync was running are therefore fetched again
+    by the next sync, however long the sync takes.
+
+    The next sync only asks for objects changed since the high-water mark,
+    minus overlap to allow for clock skew between the servers. Objects in
+    the overlap are fetched again and replaced in the store.
+
+    :param SyncStore store: Where to save objects and high-water marks.
+    :param datetime.timedelta overlap: How far before the high-water mark to
+        start fetching.
+    :param int chunk_size: Objects per request and per save to the store.
+    """
+    TIMESTAMP_FIELDS = ['changed_utc', 'modified_utc']
+
+    def __init__(self, store, overlap=datetime.timedelta(minutes=5),
+                 chunk_size=200):
+        self.store = store
+        self.overlap = overlap
+        self.chunk_size = chunk_size
+
+    def get_timestamp_field(self, model):
+        for field_name in self.TIMESTAMP_FIELDS:
+            if field_name in model._schema_items:
+                return field_name
+        raise VismaClientException(
+            f'{model.__name__} has no change timestamp field to sync on. '
+            f'Looked for {self.TIMESTAMP_FIELDS}')
+
+    def sync(self, model, full=False):
+        """
+        Sync changed objects of model to the store. If full is True, or the
+        model has not been synced before, all objects are fetched.
+
+        :returns: Number of objects fetched.
+        """
+        field_name = self.get_timestamp_field(model)
+        high_water_mark = None if full else self.store.get_high_water_mark(
+            model)
+
+        queryset = model.objects.all().order_by(field_name)
+        since = None
+        if high_water_mark is not None:
+            since = high_water_mark - self.overlap
+
+        logger.debug(f'Syncing {model.__name__} changed since '
+                     f'{high_water_mark}')
+
+        number_of_objects = 0
+        server_time = None
+        # The ids of the saved objects changed at since.
+        saved_ids = set()
+        while True:
+            chunk_queryset = queryset
+            if since is not None:
+                chunk_queryset = queryset.filter(
+                    **{f'{field_name}__gte': since})
+            # Objects with the same timestamp are in any order, so ask for
+            # the ones already saved as well to be sure to get new ones.
+            limit = self.chunk_size + len(saved_ids)
+            chunk_queryset = chunk_queryset[:limit]
+            objs = chunk_queryset._iterable_class(chunk_queryset)
+            fetched = list(objs)
+            if server_time is None and objs.first_page_meta is not None:
+                server_time = objs.first_page_meta.server_time_utc
+
+            chunk = [obj for obj in fetched if str(obj.id) not in saved_ids]
+            if chunk:
+                self.store.save(model, chunk)
+                number_of_objects += len(chunk)
+
+            for obj in chunk:
+                changed = getattr(obj, field_name)
+                if changed is not None:
+                    changed = _as_utc(changed)
+                    if high_water_mark is None or changed > high_water_mark:
+                        high_water_mark = changed
+                    if since is None or changed > since:
+                        since = changed
+                        saved_ids = set()
+                if changed == since:
+                    saved_ids.add(str(obj.id))
+
+            if not chunk or len(fetched) < limit:
+                break
+
+        # Objects changed after the first request might have been missed,
+        # the next sync has to start before that.
+        if high_water_mark is not None and server_time is not None:
+            high_water_mark = min(high_water_mark, _as_utc(server_time))
+
+        # Only move the high-water mark when everything is saved, so a failed
+        # sync is done again from the same point.
+        if high_water_mark is not None:
+            self.store.set_high_water_mark(model, high_water_mark)
+
+        return number_of_objects
@@ -0,0 +1,99 @@
+import contextlib
+import json
+import os
+import tempfile
+import threading
+
+import iso8601
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # No cross process locking on platforms without fcntl, ex Windows.
+    fcntl = None
+
+
+class TokenStore:
+    """
+    Base class for storage of the OAuth2 tokens used by the API.
+
+    The refresh token can only be used once. When several processes share
+    the same credentials they must share the tokens as well, so the store
+    has a lock that is held while the tokens are refreshed. Subclass it to
+    keep the tokens somewhere else than in a file.
+    """
+
+    def load(self):
+        """
+        Return the stored tokens as a dict with the keys access_token,
+        refresh_token and expires, or None if there are no tokens.
+        """
+        raise NotImplementedError(f'The load function on {self.__class__} '
+                                  f'needs to be overridden')
+
+    def save(self, tokens):
+        """Store the tokens. Same format as returned by load()."""
+        raise NotImplementedError(f'The save function on {self.__class__} '
+                                  f'needs to be overridden')
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the lock while reading, refreshing and saving tokens."""
+        yield
+
+
+class JSONFileTokenStore(TokenStore):
+    """
+    Stores the tokens in a json file. Writes are atomic and the lock is an
+    exclusive fcntl lock on a separate lock file, so processes sharing the
+    file don't refresh the same refresh token twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self._thread_lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as token_file:
+                tokens = json.load(token_file)
+        except FileNotFoundError:
+            return None
+
+        return {'access_token': tokens['access_token'],
+                'refresh_token': tokens['refresh_token'],
+                'expires': iso8601.parse_date(tokens['expires'])}
+
+    def save(self, tokens):
+        data = {'access_token': tokens['access_token'],
+                'refresh_token': tokens['refresh_token'],
+                'expires': tokens['expires'].isoformat()}
+
+        # Write to a temporary file and move it in place so other processes
+        # never read a half written file.
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tokens')
+        try:
+            with os.fdopen(fd, 'w') as token_file:
+                json.dump(data, token_file)
+                token_file.flush()
+                os.fsync(token_file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def lock(self):
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
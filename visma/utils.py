@@ -30,4 +30,14 @@ def is_instance_or_subclass(val, class_):
     try:
         return issubclass(val, class_)
     except TypeError:
-        return isinstance(val, class_)
\ No newline at end of file
+        return isinstance(val, class_)
+
+
+def deserialize_values(schema_fields, values):
+    """
+    Return a dict with the deserialized value of each (field_name, value) in
+    values, using the field in schema_fields. None is kept as None.
+    """
+    return {field_name: (schema_fields[field_name].deserialize(value)
+                         if value is not None else None)
+            for field_name, value in values}